@@ -0,0 +1,148 @@
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Optional
+
+from metadata_cache import STATIC_FIELDS
+
+# Downloads that haven't been touched in this long were interrupted, and are cleaned up at startup
+STALE_PARTIAL = 3600
+
+
+class AudioCache:
+    """Size-bounded directory of downloaded audio, keyed by video id.
+
+    Each entry is an audio file `<id>.<ext>` with a `<id>.json` sidecar holding its static metadata, so a hit can
+    be played without any extraction at all. Downloads happen in a private directory under `.partial` and are
+    moved into place with an atomic rename once they are complete, so a partial download is never played.
+    The least recently used entries are evicted once the cache grows past `max_bytes`.
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._files = OrderedDict()  # video id -> (filename, size), least recently used first
+        self._lock = threading.Lock()
+
+        os.makedirs(self.__partial_dir(), exist_ok=True)
+        self.__clean_partial()
+        self.__scan()
+
+    def __contains__(self, video_id):
+        return video_id in self._files
+
+    def lookup(self, video_id: str) -> Optional[tuple]:
+        """Returns (path to the audio file, metadata) if the video is cached, and marks it as recently used."""
+        with self._lock:
+            entry = self._files.get(video_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._files.move_to_end(video_id)
+            self.hits += 1
+
+        filename = os.path.join(self.path, entry[0])
+        try:
+            with open(os.path.join(self.path, f"{video_id}.json"), 'r') as f:
+                data = json.load(f)
+            # The access time is what orders the LRU after a restart
+            os.utime(filename)
+        except (OSError, ValueError):
+            self.__forget(video_id)
+            return None
+        return filename, data
+
+    def download(self, ytdl_cls, ytdl_opts: dict, url: str) -> tuple:
+        """Downloads `url` into the cache and returns (path to the audio file, info dict).
+        This blocks for as long as the download takes, so call it from an executor."""
+        partial_dir = os.path.join(self.__partial_dir(), uuid.uuid4().hex)
+        opts = {**ytdl_opts, 'outtmpl': os.path.join(partial_dir, '%(id)s.%(ext)s'), 'noplaylist': True}
+        try:
+            with ytdl_cls(opts) as ytdl:
+                data = ytdl.extract_info(url=url, download=True)
+            if 'entries' in data:
+                data = data['entries'][0]
+
+            # Postprocessors may have changed the extension, so ask for where the file really ended up
+            downloaded = data['requested_downloads'][0]['filepath']
+            filename = f"{data['id']}{os.path.splitext(downloaded)[1]}"
+
+            tmp = os.path.join(partial_dir, f"{data['id']}.json")
+            with open(tmp, 'w') as f:
+                json.dump({k: data[k] for k in STATIC_FIELDS if k in data}, f)
+            os.replace(tmp, os.path.join(self.path, f"{data['id']}.json"))
+            os.replace(downloaded, os.path.join(self.path, filename))
+        finally:
+            shutil.rmtree(partial_dir, ignore_errors=True)
+
+        with self._lock:
+            old = self._files.pop(data['id'], None)
+            if old is not None:
+                self.size -= old[1]
+            size = os.path.getsize(os.path.join(self.path, filename))
+            self._files[data['id']] = (filename, size)
+            self.size += size
+        self.__evict()
+
+        return os.path.join(self.path, filename), data
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'files': len(self._files), 'bytes': self.size}
+
+    def __scan(self):
+        found = []
+        for filename in os.listdir(self.path):
+            video_id, ext = os.path.splitext(filename)
+            if ext == '.json' or filename.startswith('.'):
+                continue
+            if not os.path.exists(os.path.join(self.path, f"{video_id}.json")):
+                continue
+            stat = os.stat(os.path.join(self.path, filename))
+            found.append((stat.st_atime, video_id, filename, stat.st_size))
+
+        for _, video_id, filename, size in sorted(found):
+            self._files[video_id] = (filename, size)
+            self.size += size
+        self.__evict()
+
+    def __clean_partial(self):
+        # Other shard workers may share the directory, so only remove downloads which are clearly dead
+        for name in os.listdir(self.__partial_dir()):
+            path = os.path.join(self.__partial_dir(), name)
+            try:
+                if time.time() - os.path.getmtime(path) > STALE_PARTIAL:
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError:
+                pass
+
+    def __evict(self):
+        while True:
+            with self._lock:
+                # Never evict the newest entry, even if it is bigger than the whole budget
+                if self.size <= self.max_bytes or len(self._files) <= 1:
+                    return
+                video_id = next(iter(self._files))
+            self.__forget(video_id)
+
+    def __forget(self, video_id):
+        with self._lock:
+            entry = self._files.pop(video_id, None)
+            if entry is None:
+                return
+            self.size -= entry[1]
+        for filename in (entry[0], f"{video_id}.json"):
+            try:
+                os.remove(os.path.join(self.path, filename))
+            except OSError:
+                pass
+
+    def __partial_dir(self):
+        return os.path.join(self.path, '.partial')
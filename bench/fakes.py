@@ -0,0 +1,270 @@
+"""
+Local stand-ins for yt_dlp and the discord objects the player touches, so the extraction -> queue -> playback path
+can be driven without a network connection or a discord gateway.
+"""
+import asyncio
+import logging
+import os
+import subprocess
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import discord
+
+from metadata_cache import cache_key
+
+FRAME_LENGTH = 0.02  # Seconds of audio in one discord frame
+
+
+def make_audio_files(path: str, count: int, seconds: float) -> [str]:
+    """Renders `count` short sine tones with ffmpeg, to play in place of youtube streams."""
+    os.makedirs(path, exist_ok=True)
+    files = []
+    for i in range(count):
+        filename = os.path.join(path, f"tone-{i}-{seconds}s.webm")
+        if not os.path.exists(filename):
+            subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-f', 'lavfi',
+                            '-i', f"sine=frequency={220 + 20 * i}:duration={seconds}",
+                            '-ac', '2', '-ar', '48000', '-c:a', 'libopus', filename], check=True)
+        files.append(filename)
+    return files
+
+
+class FakeYoutubeDL:
+    """Answers extract_info from canned info dicts, sleeping for `latency` seconds to stand in for the network."""
+
+    def __init__(self, files: [str], seconds: float, latency: float = 0.):
+        self.latency = latency
+        self.calls = 0
+        self.videos = {}
+        for i, filename in enumerate(files):
+            video_id = f"bench{i:06d}"[:11]
+            self.videos[video_id] = {
+                'id': video_id,
+                'title': f"Benchmark tone {i}",
+                'webpage_url': f"https://www.youtube.com/watch?v={video_id}",
+                'duration': seconds,
+                'url': filename,
+                'acodec': 'opus',
+                'ext': 'webm',
+                'extractor': 'youtube',
+            }
+        self._lock = threading.Lock()
+
+    def url(self, i: int) -> str:
+        return list(self.videos.values())[i % len(self.videos)]['webpage_url']
+
+    def extract_info(self, url, download=False, process=True):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.latency)
+
+        if 'list=' in url:
+            videos = list(self.videos.values())
+            entries = ({'_type': 'url', 'ie_key': 'Youtube', 'id': v['id'], 'url': v['webpage_url'],
+                        'title': v['title'], 'duration': v['duration']} for v in videos)
+            return {'_type': 'playlist', 'title': 'Benchmark playlist', 'entries': entries}
+        return dict(self.videos[cache_key(url)])
+
+
+class FakeVoiceClient:
+    """Reads frames from the playing source every 20ms on its own thread, like discord's AudioPlayer does, Opus
+    encoding them first if the source is PCM, and records when each track produced its first and last frame.
+    Songs played back to back through one gapless chain are recorded as separate tracks, from the frame the chain
+    handed over on."""
+
+    def __init__(self, guild):
+        self.guild = guild
+        self.source = None
+        self.channel = SimpleNamespace(id=guild.id, name=f"voice-{guild.id}")
+        self.tracks = []  # [started, first frame, last frame] per track
+        self.encoder = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def is_playing(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def is_connected(self):
+        return True
+
+    def play(self, source, *, after=None):
+        self.source = source
+        if not source.is_opus() and self.encoder is None:
+            self.encoder = discord.opus.Encoder()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self.__run, args=(source, after), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    async def disconnect(self, *, force=False):
+        self.stop()
+        self.guild.voice_client = None
+
+    def __run(self, source, after):
+        track = [time.perf_counter(), None, None]
+        self.tracks.append(track)
+        # A GaplessSource moves on to the next song under the same play()
+        playing = getattr(source, 'current', source)
+        next_frame = time.perf_counter()
+        while not self._stopped.is_set():
+            data = source.read()
+            if not data:
+                break
+            if getattr(source, 'current', source) is not playing:
+                playing = source.current
+                track = [time.perf_counter(), None, None]
+                self.tracks.append(track)
+            if not source.is_opus():
+                # Sent frames are always Opus, so the voice client encodes PCM itself
+                data = self.encoder.encode(data, discord.opus.Encoder.SAMPLES_PER_FRAME)
+            now = time.perf_counter()
+            if track[1] is None:
+                track[1] = now
+            track[2] = now
+            next_frame += FRAME_LENGTH
+            time.sleep(max(0., next_frame - time.perf_counter()))
+        if after is not None:
+            after(None)
+
+
+class FakeMessage:
+    def __init__(self, channel, content=None, embed=None):
+        self.channel = channel
+        self.content = content
+        self.embed = embed
+        self.id = len(channel.messages)
+        self.created_at = datetime.now(timezone.utc)
+
+    async def edit(self, *, content=None, embed=None):
+        self.content = content or self.content
+        self.embed = embed or self.embed
+        self.channel.edits += 1
+        return self
+
+
+class FakeChannel:
+    def __init__(self, channel_id):
+        self.id = channel_id
+        self.messages = []
+        self.edits = 0
+
+    async def send(self, content=None, *, embed=None, **kwargs):
+        message = FakeMessage(self, content, embed)
+        self.messages.append(message)
+        return message
+
+
+class FakeHTTP:
+    """Stand-in for discord's HTTP API, as an outbox Transport. Every channel gets discord's limit of 5 messages per
+    5 seconds: a request over it counts as rate limited and is held until the limit resets, which is what discord.py
+    does when it gets a 429."""
+
+    def __init__(self, limit: int = 5, per: float = 5.):
+        self.limit = limit
+        self.per = per
+        self.requests = 0
+        self.rate_limited = 0
+        self._recent = {}  # channel id -> times of recent requests
+
+    async def send(self, channel, *, content=None, embed=None):
+        await self.__request(channel.id)
+        return await channel.send(content, embed=embed)
+
+    async def edit(self, message, *, content=None, embed=None):
+        await self.__request(message.channel.id)
+        return await message.edit(content=content, embed=embed)
+
+    async def __request(self, channel_id):
+        recent = self._recent.setdefault(channel_id, deque())
+        now = time.monotonic()
+        while recent and now - recent[0] >= self.per:
+            recent.popleft()
+        if len(recent) >= self.limit:
+            self.rate_limited += 1
+            await asyncio.sleep(self.per - (now - recent[0]))
+        recent.append(time.monotonic())
+        self.requests += 1
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.voice_client = None
+        self.members = {}
+
+    def get_member(self, member_id):
+        return self.members.get(member_id)
+
+
+class FakeBot:
+    def __init__(self, config, loop):
+        self.config = config
+        self.loop = loop
+        self.logger = logging.getLogger("ytbot")
+        self.latency = 0.
+        self.closed = False
+        self.user = SimpleNamespace(id=0, name="ytbot")
+
+    async def wait_until_ready(self):
+        return
+
+    def is_closed(self):
+        return self.closed
+
+    def get_cog(self, name):
+        return getattr(self, 'cogs', {}).get(name)
+
+
+class FakeContext:
+    """Just enough of a commands.Context to invoke the cog's commands with."""
+
+    def __init__(self, bot, cog, guild, channel, author):
+        self.bot = bot
+        self.cog = cog
+        self.guild = guild
+        self.channel = channel
+        self.author = author
+        self.interaction = None  # Invoked like a prefix command
+
+    @property
+    def voice_client(self):
+        return self.guild.voice_client
+
+    def typing(self):
+        return _NullContext()
+
+    async def send(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+    async def invoke(self, command, *args, **kwargs):
+        return await command.callback(self.cog, self, *args, **kwargs)
+
+
+class _NullContext:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+def make_guild(bot, cog, guild_id: int):
+    """Builds a guild which is already connected to voice, and a context for a member of it."""
+    guild = FakeGuild(guild_id)
+    guild.voice_client = FakeVoiceClient(guild)
+    author = SimpleNamespace(id=guild_id * 10, mention=f"<@{guild_id * 10}>", guild=guild, bot=False,
+                             voice=SimpleNamespace(channel=guild.voice_client.channel))
+    guild.members[author.id] = author
+    return FakeContext(bot, cog, guild, FakeChannel(guild_id), author)
+
+
+def new_event_loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    return loop
@@ -0,0 +1,195 @@
+"""
+Offline benchmark of the /play -> extraction -> queue -> playback path.
+
+yt_dlp is swapped for canned info dicts pointing at local audio files, and every guild gets a fake voice client which
+paces reads like discord's AudioPlayer. Results are tagged with the git commit, so runs can be compared across commits.
+
+Usage: python -m bench.run [--guilds 50] [--tracks 3] [--track-seconds 5] [--extract-latency 0.3] [--gapless]
+                           [--out bench.json]
+       python -m bench.run --compare old.json new.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from bench import fakes
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def summarize(values):
+    return {'p50': percentile(values, 50), 'p95': percentile(values, 95), 'max': max(values) if values else None}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def cpu_seconds():
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+async def scenario(args, workdir):
+    from cogs.youtube import Youtube
+    from yt_dl_source import YTDLSource
+
+    files = fakes.make_audio_files(os.path.join(workdir, 'audio'), args.videos, args.track_seconds)
+    config = {
+        'audio_cache_dir': os.path.join(workdir, 'cache'),
+        'playback_mode': args.mode,
+        'extraction_workers': args.workers,
+        'gapless': args.gapless,
+    }
+    bot = fakes.FakeBot(config, asyncio.get_running_loop())
+    cog = Youtube(bot)
+    ytdl = fakes.FakeYoutubeDL(files, args.track_seconds, latency=args.extract_latency)
+    YTDLSource.ytdl = ytdl
+    http = fakes.FakeHTTP()
+    cog.outbox.transport = http
+
+    tracemalloc.start()
+    memory_before = tracemalloc.get_traced_memory()[0]
+    contexts = [fakes.make_guild(bot, cog, guild_id) for guild_id in range(1, args.guilds + 1)]
+    invoked = {}
+
+    async def play(ctx):
+        invoked[ctx.guild.id] = time.perf_counter()
+        for i in range(args.tracks):
+            await Youtube.play.callback(cog, ctx, q=ytdl.url(ctx.guild.id + i))
+
+    cpu_before = cpu_seconds()
+    wall_before = time.perf_counter()
+    await asyncio.gather(*(play(ctx) for ctx in contexts))
+
+    # Memory is measured once every guild is playing, with its queue full
+    deadline = time.perf_counter() + args.timeout
+    while any(not ctx.guild.voice_client.tracks for ctx in contexts) and time.perf_counter() < deadline:
+        await asyncio.sleep(.05)
+    memory_per_guild = (tracemalloc.get_traced_memory()[0] - memory_before) / args.guilds
+    tracemalloc.stop()
+
+    def finished(ctx):
+        tracks = ctx.guild.voice_client.tracks
+        return len(tracks) >= args.tracks and not ctx.guild.voice_client.is_playing()
+
+    while not all(finished(ctx) for ctx in contexts) and time.perf_counter() < deadline:
+        await asyncio.sleep(.1)
+    cpu = cpu_seconds() - cpu_before
+    wall = time.perf_counter() - wall_before
+
+    first_audio, gaps, streamed = [], [], 0.
+    for ctx in contexts:
+        tracks = [t for t in ctx.guild.voice_client.tracks if t[1] is not None]
+        if tracks:
+            first_audio.append(tracks[0][1] - invoked[ctx.guild.id])
+        gaps += [b[1] - a[2] for a, b in zip(tracks, tracks[1:])]
+        streamed += sum(t[2] - t[1] for t in tracks)
+
+    bot.closed = True
+    for ctx in contexts:
+        ctx.guild.voice_client.stop()
+    for task in asyncio.all_tasks():
+        if task is not asyncio.current_task():
+            task.cancel()
+
+    return {
+        'time_to_first_audio': summarize(first_audio),
+        'gap_between_tracks': summarize(gaps),
+        'cpu_per_stream': cpu / streamed if streamed else None,
+        'memory_per_guild_kb': memory_per_guild / 1024,
+        'extractions': ytdl.calls,
+        'messages_per_guild': http.requests / args.guilds,
+        'rate_limited_requests': http.rate_limited,
+        'incomplete_guilds': sum(not finished(ctx) for ctx in contexts),
+        'wall_seconds': wall,
+    }
+
+
+def flatten(results, prefix=''):
+    for key, value in results.items():
+        if isinstance(value, dict):
+            yield from flatten(value, f"{prefix}{key}.")
+        else:
+            yield f"{prefix}{key}", value
+
+
+def fmt(value):
+    if value is None:
+        return '-'
+    return str(value) if isinstance(value, int) else f"{value:.4f}"
+
+
+def report(results):
+    for key, value in flatten(results['metrics']):
+        print(f"{key:32} {fmt(value)}")
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    if old['params'] != new['params']:
+        print("warning: the runs used different parameters, the numbers may not be comparable", file=sys.stderr)
+
+    print(f"{'metric':32} {old['commit'] or 'old':>12} {new['commit'] or 'new':>12} {'change':>8}")
+    new_metrics = dict(flatten(new['metrics']))
+    for key, before in flatten(old['metrics']):
+        after = new_metrics.get(key)
+        change = f"{(after - before) / before * 100:+.1f}%" if before and after is not None else ''
+        print(f"{key:32} {fmt(before):>12} {fmt(after):>12} {change:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--guilds', type=int, default=50)
+    parser.add_argument('--tracks', type=int, default=3, help="songs queued per guild")
+    parser.add_argument('--videos', type=int, default=10, help="distinct videos shared between the guilds")
+    parser.add_argument('--track-seconds', type=float, default=5.)
+    parser.add_argument('--extract-latency', type=float, default=.3, help="simulated yt_dlp latency in seconds")
+    parser.add_argument('--workers', type=int, default=4, help="extraction_workers")
+    parser.add_argument('--mode', choices=['pcm', 'opus'], default='pcm', help="playback_mode")
+    parser.add_argument('--gapless', action='store_true', help="start each song on the previous one's last frame")
+    parser.add_argument('--timeout', type=float, default=300.)
+    parser.add_argument('--out', help="write the results to this json file")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="compare two result files")
+    args = parser.parse_args()
+
+    if args.compare:
+        return compare(*args.compare)
+
+    params = {k: v for k, v in vars(args).items() if k not in ('out', 'compare', 'timeout')}
+    with tempfile.TemporaryDirectory(prefix="ytbot-bench-") as workdir:
+        metrics = asyncio.run(scenario(args, workdir))
+    results = {
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'params': params,
+        'metrics': metrics,
+    }
+    report(results)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
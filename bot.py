@@ -1,16 +1,22 @@
+import time
+started_at = time.perf_counter()  # Startup phases are timed from here, so imports are included
+
 import asyncio
+import json
 import yaml
 import logging
 import os
 import platform
 import random
+import signal
 import sys
 import discord
 import glob
 import hashlib
-import nest_asyncio
+import log_pipeline
+import metrics
 from discord.ext import commands, tasks
-from discord.ext.commands import Bot, Context
+from discord.ext.commands import AutoShardedBot, Bot, Context
 
 if not os.path.isfile(f"{os.path.realpath(os.path.dirname(__file__))}/config.yaml"):
     sys.exit("'config.yaml' not found!")
@@ -22,24 +28,68 @@ else:
 # intents = discord.Intents(messages=True, voice_states=True, guilds=True, integrations=True)
 intents = discord.Intents.default()
 
+# Set by shard_launcher.py when this process is one worker of a sharded deployment
+worker = os.environ.get("YTBOT_WORKER")
+shard_ids = os.environ.get("YTBOT_SHARD_IDS")
+shard_count = os.environ.get("YTBOT_SHARD_COUNT")
+
 # Create logger and add handler
 logger = logging.getLogger("ytbot")
 logger.setLevel(config.get("log_level") or logging.DEBUG)
 # logger.addHandler(logging.StreamHandler())
-fh = logging.FileHandler(config.get("logfile") or 'ytbot.log')
-fmt = logging.Formatter(fmt='%(asctime)s %(levelname)-8s %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-fh.setFormatter(fmt)
-fh.setLevel(logging.DEBUG)
-logger.addHandler(fh)
+logfile = config.get("logfile") or 'ytbot.log'
+if worker is not None:
+    # One logfile per worker, so processes don't interleave their writes
+    root, ext = os.path.splitext(logfile)
+    logfile = f"{root}-{worker}{ext}"
+# Written from a background thread, so logging never blocks the event loop
+log_pipeline.setup(logger, logfile, structured=config.get("log_json", False),
+                   max_bytes=config.get("log_max_bytes") or 10 * 1024 ** 2, backups=config.get("log_backups", 5),
+                   debug_rate=config.get("log_debug_rate", 5))
 
 # Create bot and add logger/config
-bot = Bot(command_prefix=commands.when_mentioned, intents=intents, help_command=None, case_insensitive=True)
+if shard_ids:
+    bot = AutoShardedBot(command_prefix=commands.when_mentioned, intents=intents, help_command=None,
+                         case_insensitive=True, shard_ids=[int(i) for i in shard_ids.split(",")],
+                         shard_count=int(shard_count))
+else:
+    bot = Bot(command_prefix=commands.when_mentioned, intents=intents, help_command=None, case_insensitive=True)
 bot.logger = logger
 bot.config = config
+bot.worker = worker
 bot.yt_player = None
+bot.metrics_server = None
+bot.ready_once = False
+
+metrics.gauge("ytbot_gateway_latency_seconds", "Heartbeat latency to the discord gateway").set_function(
+    lambda: bot.latency)
+metrics.gauge("ytbot_guilds", "Guilds this process is in").set_function(lambda: len(bot.guilds))
+STARTUP_SECONDS = metrics.gauge("ytbot_startup_seconds", "Time spent in each phase of startup", ("phase",))
+
+last_phase_at = started_at
+
+
+def end_phase(phase: str) -> None:
+    """Records how long the startup phase that just finished took."""
+    global last_phase_at
+    now = time.perf_counter()
+    STARTUP_SECONDS.set(now - last_phase_at, phase=phase)
+    logger.info(f"Startup: {phase} took {now - last_phase_at:.2f}s ({now - started_at:.2f}s total)")
+    last_phase_at = now
+
+
+end_phase("imports and config")
+
+project_hash = None
 
 
 def get_proj_hash() -> str:
+    """md5 of the project's sources and config. The files don't change while the bot runs, so this is only
+    computed once."""
+    global project_hash
+    if project_hash is not None:
+        return project_hash
+
     filenames = glob.glob("**[!venv]/*.py", recursive=True)
     filenames += glob.glob("*.py")
     filenames += glob.glob("*.yaml")
@@ -50,7 +100,36 @@ def get_proj_hash() -> str:
             data = inputfile.read()
             md5.update(data)
 
-    return md5.hexdigest()
+    project_hash = md5.hexdigest()
+    return project_hash
+
+
+def get_command_tree_hash() -> str:
+    """Hash of the application commands exactly as a sync would send them to discord."""
+    commands_json = [command.to_dict() for command in bot.tree.get_commands()]
+    payload = json.dumps({"application_id": bot.application_id, "commands": commands_json}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+async def sync_command_tree() -> bool:
+    """Syncs the application commands, but only if they changed since the last successful sync.
+    tree.sync() is slow and heavily rate limited, and the commands only change when the code does."""
+    path = config.get("command_tree_hash_file") or "cache/command_tree.hash"
+    current = get_command_tree_hash()
+    try:
+        with open(path) as f:
+            if f.read().strip() == current:
+                bot.logger.info("Application commands are unchanged, skipping sync")
+                return False
+    except FileNotFoundError:
+        pass
+
+    synced = await bot.tree.sync()
+    bot.logger.info(f"Synced {len(synced)} application command(s)")
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(current)
+    return True
 
 
 """
@@ -58,16 +137,35 @@ Executes when the bot is ready
 """
 @bot.event
 async def on_ready() -> None:
+    if bot.ready_once:
+        # Reconnected, everything below has already been done
+        bot.logger.info(f"Reconnected as {bot.user.name}")
+        return
+    bot.ready_once = True
+    end_phase("login")
+
     bot.logger.debug("-------------------")
-    bot.logger.debug(f"project hash: {get_proj_hash()}")
+    bot.logger.debug(f"project hash: {await asyncio.to_thread(get_proj_hash)}")
     bot.logger.debug("-------------------")
     bot.logger.info(f"Logged in as {bot.user.name}")
     bot.logger.info(f"discord.py API version: {discord.__version__}")
     bot.logger.info(f"Python version: {platform.python_version()}")
     bot.logger.info(f"Running on: {platform.system()} {platform.release()} ({os.name})")
+    if shard_ids:
+        bot.logger.info(f"Worker {worker}: shards {shard_ids} of {shard_count}")
     bot.logger.info("-------------------")
-    status_task.start()
-    await bot.tree.sync()
+    if not status_task.is_running():
+        status_task.start()
+    if config.get("metrics_port") and bot.metrics_server is None:
+        port = config["metrics_port"]
+        if worker is not None:
+            # Every worker needs its own port
+            port += int(worker)
+        bot.metrics_server = await metrics.start_http_server(port, config.get("metrics_host") or "127.0.0.1")
+    # Application commands are global, so only one worker needs to sync them
+    if worker in (None, "0"):
+        await sync_command_tree()
+        end_phase("command sync")
 
 
 @tasks.loop(minutes=0.5)
@@ -215,19 +313,42 @@ async def on_command_error(context: Context, error) -> None:
 
 
 async def load_cogs() -> None:
-    logger.info(f"loading cogs from '{os.path.realpath(os.path.dirname(__file__))}/cogs'...")
-    logger.info(f"content: {os.listdir(f'{os.path.realpath(os.path.dirname(__file__))}/cogs')}")
-    for file in os.listdir(f"{os.path.realpath(os.path.dirname(__file__))}/cogs"):
-        if file.endswith(".py"):
-            extension = file[:-3]
-            try:
-                await bot.load_extension(f"cogs.{extension}")
-                bot.logger.info(f"Loaded extension '{extension}'")
-            except Exception as e:
-                exception = f"{type(e).__name__}: {e}"
-                bot.logger.error(
-                    f"Failed to load extension {extension}\n{exception}")
-
-nest_asyncio.apply()
-asyncio.run(load_cogs())
-bot.run(config["token"])
+    """Loads every extension in cogs/ concurrently."""
+    cogs_dir = f"{os.path.realpath(os.path.dirname(__file__))}/cogs"
+    extensions = [file[:-3] for file in sorted(os.listdir(cogs_dir)) if file.endswith(".py")]
+    logger.info(f"loading cogs {extensions} from '{cogs_dir}'...")
+    await asyncio.gather(*(load_cog(extension) for extension in extensions))
+
+
+async def load_cog(extension: str) -> None:
+    start = time.perf_counter()
+    try:
+        await bot.load_extension(f"cogs.{extension}")
+        bot.logger.info(f"Loaded extension '{extension}' in {time.perf_counter() - start:.2f}s")
+    except Exception as e:
+        exception = f"{type(e).__name__}: {e}"
+        bot.logger.error(
+            f"Failed to load extension {extension}\n{exception}")
+
+
+async def main() -> None:
+    # Cogs are loaded on the same loop the bot runs on, so tasks they start in cog_load keep running
+    async with bot:
+        # shard_launcher.py and docker stop the bot with SIGTERM. Closing the bot unloads the cogs, which lets
+        # them checkpoint their players.
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(signal.SIGTERM, lambda: loop.create_task(bot.close()))
+        except NotImplementedError:
+            pass  # Not supported on Windows
+        await load_cogs()
+        end_phase("cogs")
+        await bot.start(config["token"])
+
+
+# bot.run() would have set this up, for discord.py's own logger only
+discord.utils.setup_logging(root=False)
+try:
+    asyncio.run(main())
+except KeyboardInterrupt:
+    pass
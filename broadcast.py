@@ -0,0 +1,194 @@
+import collections
+import logging
+import threading
+import time
+
+import discord
+
+import metrics
+
+logger = logging.getLogger("ytbot")
+
+FRAME_SECONDS = discord.opus.Encoder.FRAME_LENGTH / 1000
+SILENCE = b'\x00' * discord.opus.Encoder.FRAME_SIZE
+
+BROADCAST_UNDERRUNS = metrics.counter("ytbot_broadcast_underruns_total",
+                                      "Frames a broadcast listener had to fill with silence")
+
+
+class Subscriber(discord.AudioSource):
+    """One listener of a Broadcast, played by a single voice client. Wrap it in a PCMVolumeTransformer to give the
+    listener its own volume.
+
+    Frames are pushed in by the broadcast and read out by the voice client, through a short queue. Reading starts once
+    `prebuffer` frames are queued, so the two threads' timing jitter doesn't turn into gaps. If the listener falls
+    more than `max_frames` behind, the oldest frames are dropped.
+    """
+
+    def __init__(self, broadcast, prebuffer: int = 5, max_frames: int = 50):
+        self.broadcast = broadcast
+        self.prebuffer = prebuffer
+        self._frames = collections.deque(maxlen=max_frames)
+        self._ready = False
+        self._ended = False
+
+    def push(self, frame: bytes):
+        self._frames.append(frame)
+
+    def end(self):
+        self._ended = True
+
+    def read(self) -> bytes:
+        if not self._ready:
+            if len(self._frames) < self.prebuffer and not self._ended:
+                return SILENCE
+            self._ready = True
+        try:
+            return self._frames.popleft()
+        except IndexError:
+            if self._ended:
+                return b''
+            # Fell behind the broadcast, wait for a few frames before carrying on
+            self._ready = False
+            BROADCAST_UNDERRUNS.inc()
+            return SILENCE
+
+    def is_opus(self) -> bool:
+        return False
+
+    def cleanup(self):
+        self.broadcast.unsubscribe(self)
+
+
+class Broadcast:
+    """Decodes one stream once, and hands every frame to all of its subscribers.
+
+    A pacing thread reads 20ms frames from the source at real time, the same rate the voice clients read them. The
+    source is opened by calling `open_source`, from the pacing thread. A live stream whose source ends is reopened,
+    since that usually means its url expired. The broadcast stops once it has had no subscribers for `linger`
+    seconds, so a guild can switch away and back without the stream restarting.
+    """
+
+    def __init__(self, key: str, open_source, *, live: bool = False, linger: float = 10., on_end=None):
+        self.key = key
+        self.live = live
+        self.linger = linger
+        self.frames = 0
+        self.ended = False
+
+        self._open_source = open_source
+        self._on_end = on_end
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    def start(self):
+        threading.Thread(target=self.__run, name=f"broadcast-{self.key}", daemon=True).start()
+        return self
+
+    def subscribe(self, **kwargs):
+        """Adds a listener, or returns None if the broadcast has already ended."""
+        with self._lock:
+            if self.ended:
+                return None
+            subscriber = Subscriber(self, **kwargs)
+            self._subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        with self._lock:
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
+
+    def stop(self):
+        self._stopped.set()
+
+    def __run(self):
+        source = None
+        restarts = 0
+        idle_since = None
+        try:
+            next_frame = time.perf_counter()
+            while not self._stopped.is_set():
+                if source is None:
+                    source = self._open_source()
+                frame = source.read()
+                if not frame:
+                    source.cleanup()
+                    source = None
+                    if self.live and restarts < 3:
+                        restarts += 1
+                        logger.info(f"Broadcast {self.key} ended, reopening it")
+                        continue
+                    break
+                self.frames += 1
+
+                with self._lock:
+                    subscribers = list(self._subscribers)
+                for subscriber in subscribers:
+                    subscriber.push(frame)
+
+                now = time.perf_counter()
+                if subscribers:
+                    idle_since = None
+                elif idle_since is None:
+                    idle_since = now
+                elif now - idle_since > self.linger:
+                    break
+
+                next_frame += FRAME_SECONDS
+                if next_frame > now:
+                    time.sleep(next_frame - now)
+                elif now - next_frame > .2:
+                    # Fell well behind (the source stalled), don't burst to catch up
+                    next_frame = now
+        except Exception as e:
+            logger.error(f"Broadcast {self.key} failed: {e}")
+        finally:
+            if source is not None:
+                source.cleanup()
+            with self._lock:
+                self.ended = True
+                subscribers = list(self._subscribers)
+            for subscriber in subscribers:
+                subscriber.end()
+            if self._on_end is not None:
+                self._on_end(self)
+            logger.debug(f"Broadcast {self.key} stopped after {self.frames} frames")
+
+
+class BroadcastHub:
+    """The running broadcasts, by key. Subscribing to a key that isn't being broadcast starts it."""
+
+    def __init__(self, linger: float = 10.):
+        self.linger = linger
+        self._broadcasts = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, key: str, open_source, *, live: bool = False) -> Subscriber:
+        with self._lock:
+            broadcast = self._broadcasts.get(key)
+            subscriber = broadcast.subscribe() if broadcast is not None else None
+            if subscriber is None:
+                broadcast = Broadcast(key, open_source, live=live, linger=self.linger, on_end=self.__remove)
+                self._broadcasts[key] = broadcast
+                subscriber = broadcast.subscribe()
+                broadcast.start()
+        return subscriber
+
+    def listeners(self, key: str) -> int:
+        broadcast = self._broadcasts.get(key)
+        return len(broadcast) if broadcast is not None else 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            broadcasts = list(self._broadcasts.values())
+        return {'broadcasts': len(broadcasts), 'subscribers': sum(len(b) for b in broadcasts)}
+
+    def __remove(self, broadcast):
+        with self._lock:
+            if self._broadcasts.get(broadcast.key) is broadcast:
+                del self._broadcasts[broadcast.key]
@@ -1,4 +1,6 @@
+import asyncio
 import threading
+import time
 
 import discord
 import platform
@@ -6,10 +8,23 @@ import os
 from discord.ext import commands
 from discord.ext.commands import Context
 
+from loop_monitor import LoopLagMonitor, SamplingProfiler
+from memory_accounting import accountant
+
+MAX_PROFILE_SECONDS = 60
+
 
 class Debug(commands.Cog, name="debug"):
     def __init__(self, bot):
         self.bot = bot
+        self.lag_monitor = LoopLagMonitor(threshold=bot.config.get("loop_lag_threshold") or .25)
+        self._profiling = False
+
+    async def cog_load(self) -> None:
+        self.lag_monitor.start()
+
+    async def cog_unload(self) -> None:
+        self.lag_monitor.stop()
 
     @commands.hybrid_command(
         name="help",
@@ -83,6 +98,101 @@ class Debug(commands.Cog, name="debug"):
         )
         await context.send(embed=embed)
 
+    @commands.hybrid_command(
+        name="lag",
+        description="Show recent event loop stalls.",
+    )
+    async def lag(self, context: Context) -> None:
+        stalls = list(self.lag_monitor.stalls)
+        embed = discord.Embed(
+            title="Event loop stalls",
+            description=f"{len(stalls)} stall(s) over {self.lag_monitor.threshold * 1000:.0f}ms, "
+                        f"worst lag {self.lag_monitor.max_lag * 1000:.0f}ms.",
+            color=0x9C84EF
+        )
+        # Most recent first, with as much of each stack as fits in a field
+        for stall in reversed(stalls[-5:]):
+            stack = stall.stack or "(not captured)"
+            embed.add_field(
+                name=f"{stall.duration * 1000:.0f}ms at {time.strftime('%H:%M:%S', time.localtime(stall.started))}",
+                value=f"```{stack[-1000:]}```",
+                inline=False
+            )
+        await context.send(embed=embed)
+
+    @commands.hybrid_command(
+        name="profile",
+        description="Profile the bot for a few seconds and list the hottest functions.",
+    )
+    @commands.is_owner()
+    async def profile(self, context: Context, seconds: int = 10, all_threads: bool = False) -> None:
+        """Samples the event loop thread (or every thread) and replies with the functions seen most often."""
+        if self._profiling:
+            await context.send("A profile is already running.")
+            return
+        seconds = max(1, min(seconds, MAX_PROFILE_SECONDS))
+        profiler = SamplingProfiler(thread_ids=None if all_threads else {threading.get_ident()})
+
+        self._profiling = True
+        try:
+            async with context.typing():
+                await asyncio.get_running_loop().run_in_executor(None, profiler.run, seconds)
+        finally:
+            self._profiling = False
+
+        embed = discord.Embed(
+            title=f"Profile ({seconds}s, {'all threads' if all_threads else 'event loop'})",
+            description=f"```{profiler.summary()[:4000]}```",
+            color=0x9C84EF
+        )
+        await context.send(embed=embed)
+
+    @commands.hybrid_command(
+        name="memory",
+        description="Show memory retained per guild player, and changes since the last call.",
+    )
+    @commands.is_owner()
+    async def memory(self, context: Context) -> None:
+        youtube = self.bot.get_cog("youtube")
+        players = youtube.players if youtube else {}
+        shared = [self.bot, youtube, youtube.playback if youtube else None, self.bot.loop, self.bot.logger]
+        async with context.typing():
+            snapshot = await accountant.snapshot(players, shared)
+        diff = snapshot['diff']
+
+        embed = discord.Embed(
+            title="Memory",
+            description=f"{len(players)} player(s) retaining {snapshot['total'] / 1024:.1f} KiB"
+                        + (f" ({diff['total'] / 1024:+.1f} KiB in {diff['seconds']:.0f}s)" if diff else ""),
+            color=0x9C84EF
+        )
+        biggest = sorted(snapshot['guilds'].items(), key=lambda g: g[1]['bytes'], reverse=True)[:10]
+        if biggest:
+            embed.add_field(
+                name="Largest guilds",
+                value="\n".join(f"`{guild_id}` {g['bytes'] / 1024:.1f} KiB"
+                                + (f" ({diff['guilds'].get(guild_id, 0) / 1024:+.1f})" if diff else "")
+                                for guild_id, g in biggest),
+                inline=False
+            )
+            embed.add_field(
+                name="By type",
+                value="\n".join(f"`{name}` {size / 1024:.1f} KiB"
+                                + (f" ({diff['types'][name] / 1024:+.1f})" if diff else "")
+                                for name, size in snapshot['types'].most_common(10)),
+                inline=False
+            )
+
+        orphaned = accountant.orphaned(players)
+        leaked = accountant.leaked()
+        if orphaned:
+            embed.add_field(name="Players without a voice connection",
+                            value=", ".join(f"`{g}`" for g in orphaned)[:1024], inline=False)
+        if leaked:
+            embed.add_field(name="Destroyed players still in memory",
+                            value=", ".join(f"`{g}`" for g in leaked)[:1024], inline=False)
+        await context.send(embed=embed)
+
     @commands.hybrid_command(
         name="testjoin",
         description="Join the user's voice channel"
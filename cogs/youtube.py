@@ -2,13 +2,22 @@ import asyncio
 import discord
 import random
 import sys
+import time
 import traceback
-from discord.ext import commands
+from types import SimpleNamespace
+from discord.ext import commands, tasks
 from discord.ext.commands import Context
 
-import bot
+import metrics
+import util
+from memory_accounting import accountant
+from metadata_cache import cache_key, stream_expiry
+from outbox import Outbox
+from playback_scheduler import PlaybackScheduler
+from player_store import PlayerStore
+from track import Track
 from yt_dl_source import YTDLSource
-from yt_player import YtPlayer, State
+from yt_player import InvalidInputException, YtPlayer, State
 
 
 class VoiceConnectionError(commands.CommandError):
@@ -19,13 +28,133 @@ class InvalidVoiceChannel(VoiceConnectionError):
     """Exception for cases of invalid Voice Channels."""
 
 
+QUEUE_PAGE_SIZE = 10
+
+COMMANDS = metrics.counter("ytbot_commands_total", "Commands completed", ("command",))
+COMMAND_ERRORS = metrics.counter("ytbot_command_errors_total", "Commands which raised", ("command",))
+PLAY_SECONDS = metrics.histogram("ytbot_play_command_seconds", "Time for /play to queue a song or playlist")
+
+
 class Youtube(commands.Cog, name="youtube"):
     def __init__(self, bot):
         self.bot = bot
         self.players = {}
+        self.store = None
+        self._restored = False
+        # One scheduler drives playback for every guild, and disconnects players left idle for idle_timeout seconds
+        self.playback = PlaybackScheduler(bot.loop, idle_timeout=bot.config.get("idle_timeout") or 300)
+        # Messages that aren't replies to a command, batched and paced to stay inside discord's rate limits
+        self.outbox = Outbox()
+        YTDLSource.configure(bot.config)
+        YtPlayer.configure(bot.config)
+
+        metrics.gauge("ytbot_voice_clients", "Connected voice clients").set_function(
+            lambda: len(self.bot.voice_clients))
+        metrics.gauge("ytbot_players", "Guild players").set_function(lambda: len(self.players))
+        metrics.gauge("ytbot_queue_depth", "Songs queued per guild", ("guild",)).set_function(
+            lambda: {(guild_id,): player.queue.qsize() for guild_id, player in list(self.players.items())})
         if sys.platform == "darwin":
             discord.opus.load_opus('lib/darwin/libopus.0.dylib')
 
+    async def cog_load(self) -> None:
+        # Import yt_dlp in the background while the bot logs in, rather than on the first /play or on startup
+        asyncio.get_running_loop().run_in_executor(None, YTDLSource.get_ytdl)
+
+        path = self.bot.config.get("player_store", "cache/players.db")
+        if path:
+            self.store = PlayerStore(path, worker=getattr(self.bot, "worker", None) or "main")
+            self.checkpoint_players.change_interval(seconds=self.bot.config.get("checkpoint_interval") or 15)
+            self.checkpoint_players.start()
+
+    async def cog_unload(self) -> None:
+        self.playback.stop()
+        if self.store is None or not self._restored:
+            return
+        self.checkpoint_players.cancel()
+        # Last checkpoint, taken before the voice clients are disconnected on shutdown
+        store, self.store = self.store, None
+        await asyncio.get_running_loop().run_in_executor(None, store.save, self.__checkpoints())
+        store.close()
+
+    @tasks.loop(seconds=15)
+    async def checkpoint_players(self) -> None:
+        if self.store is not None and self._restored:
+            try:
+                written = await self.bot.loop.run_in_executor(None, self.store.save, self.__checkpoints())
+            except Exception as e:
+                self.bot.logger.warning(f"Failed to checkpoint players: {e}")
+            else:
+                if written:
+                    self.bot.logger.debug(f"Checkpointed {written} player(s)")
+
+    def __checkpoints(self) -> dict:
+        checkpoints = {}
+        for guild_id, player in list(self.players.items()):
+            checkpoint = player.checkpoint()
+            if checkpoint is not None:
+                checkpoints[guild_id] = checkpoint
+        return checkpoints
+
+    @commands.Cog.listener()
+    async def on_ready(self) -> None:
+        if self.store is None or self._restored:
+            return
+        try:
+            await self.restore_players()
+        finally:
+            # Only start overwriting checkpoints once they have been read back
+            self._restored = True
+
+    async def restore_players(self) -> None:
+        """Brings back the players that were running when the bot last stopped, a few guilds at a time.
+        Queued songs are restored as metadata only, so nothing is extracted until a song comes up, and stream urls
+        that were cached when the checkpoint was taken are reused for the songs playing first."""
+        start = time.perf_counter()
+        checkpoints = await self.bot.loop.run_in_executor(None, self.store.load, [g.id for g in self.bot.guilds])
+        if not checkpoints:
+            return
+        semaphore = asyncio.Semaphore(self.bot.config.get("restore_concurrency") or 5)
+        restored = await asyncio.gather(*(self.__restore_player(guild_id, state, alive_at, semaphore)
+                                          for guild_id, state, alive_at in checkpoints))
+        self.bot.logger.info(f"Restored {sum(restored)} of {len(checkpoints)} player(s) "
+                             f"in {time.perf_counter() - start:.2f}s")
+
+    async def __restore_player(self, guild_id, state, alive_at, semaphore) -> bool:
+        guild = self.bot.get_guild(guild_id)
+        channel = guild.get_channel(state['channel_id']) if guild else None
+        voice_channel = guild.get_channel(state['voice_channel_id']) if guild else None
+        if channel is None or voice_channel is None:
+            await self.bot.loop.run_in_executor(None, self.store.delete, guild_id)
+            return False
+        if guild.voice_client is not None or guild_id in self.players:
+            return False  # Someone started playing something since
+        tracks = YtPlayer.restored_tracks(state, alive_at)
+        if not tracks:
+            # The only song left would have finished by now
+            await self.bot.loop.run_in_executor(None, self.store.delete, guild_id)
+            return False
+
+        async with semaphore:
+            await self.bot.loop.run_in_executor(None, self.__seed_streams, state.get('streams') or {})
+            try:
+                await voice_channel.connect()
+            except Exception as e:
+                self.bot.logger.warning(f"Failed to rejoin {voice_channel} in guild {guild_id}: {e}")
+                await self.bot.loop.run_in_executor(None, self.store.delete, guild_id)
+                return False
+            player = self.get_player(SimpleNamespace(bot=self.bot, guild=guild, channel=channel, cog=self))
+            count = player.restore(state, tracks)
+            self.bot.logger.debug(f"Restored {count} song(s) in guild {guild_id}")
+            return True
+
+    @staticmethod
+    def __seed_streams(streams: dict) -> None:
+        now = time.time()
+        for url, info in streams.items():
+            # Urls without an expiry can't be trusted after a restart
+            if stream_expiry(info['url'], 0) > now:
+                YTDLSource.cache.put(cache_key(url), info)
+
     async def cleanup(self, guild):
         try:
             await guild.voice_client.disconnect()
@@ -33,9 +162,20 @@ class Youtube(commands.Cog, name="youtube"):
             pass
 
         try:
-            del self.players[guild.id]
+            player = self.players.pop(guild.id)
         except KeyError:
             pass
+        else:
+            # Reported by /memory if it's still around once it should have been freed
+            accountant.track_destroyed(guild.id, player)
+            if self.store is not None:
+                await self.bot.loop.run_in_executor(None, self.store.delete, guild.id)
+
+    async def cog_after_invoke(self, ctx):
+        COMMANDS.inc(command=ctx.command.qualified_name)
+
+    async def cog_command_error(self, ctx, error):
+        COMMAND_ERRORS.inc(command=ctx.command.qualified_name if ctx.command else "unknown")
 
     async def __local_check(self, ctx):
         """A local check which applies to all commands in this cog."""
@@ -62,7 +202,7 @@ class Youtube(commands.Cog, name="youtube"):
         try:
             player = self.players[ctx.guild.id]
         except KeyError:
-            player = YtPlayer(ctx, bot.logger)
+            player = YtPlayer(ctx, self.bot.logger)
             self.players[ctx.guild.id] = player
 
         return player
@@ -107,6 +247,10 @@ class Youtube(commands.Cog, name="youtube"):
         description="Join the user's voice channel and play url"
     )
     async def play(self, ctx: Context, *, q: str) -> None:
+        with PLAY_SECONDS.time():
+            await self.__play(ctx, q)
+
+    async def __play(self, ctx, q):
         async with ctx.typing():
             # TODO: Removeme; Default for testing
             if q == "q":
@@ -119,21 +263,116 @@ class Youtube(commands.Cog, name="youtube"):
 
             self.bot.logger.debug(f"Bot gathering metadata for '{q}'")
             player = self.get_player(ctx)
-            # TODO: should probably download and chunk in order to avoid http read errors messing up the stream.
-            # If download is False, source will be a dict which will be used later to regather the stream.
-            # If download is True, source will be a discord.FFmpegPCMAudio with a VolumeTransformer.
-            source = await YTDLSource.create_source(ctx, q, loop=self.bot.loop, download=False)
-
-            await player.queue.put(source)
-
-        embed = discord.Embed(
-            title="**Playing music**",
-            color=0x8D72E3
-        )
-        embed.add_field(name=f"__Now Playing__ (#{self.bot.yt_player.get_voice_channel()})",
-                        value=self.bot.yt_player.now_playing(), inline=False)
-        embed.add_field(name="__Changes to Playlist__", value=new_song, inline=False)
-        embed.add_field(name="__More Info__", value="Type `/playlist` for queued music.", inline=False)
+            q = await player.resolve(q)
+            if YtPlayer.is_playlist(q):
+                # Playlists are streamed into the queue, so the first song can start before the rest is resolved
+                title, _ = await player.enqueue_playlist(ctx, q)
+                embed = discord.Embed(title="", description=f"Queued playlist **{title}** [{ctx.author.mention}]", color=discord.Color.green())
+                await ctx.send(embed=embed)
+                return
+
+            # Set stream_buffer in config.yaml to ride out http read errors while streaming.
+            # Only the song's metadata is queued, the stream is regathered once it comes up.
+            track = await YTDLSource.create_source(ctx, q, loop=self.bot.loop, download=False)
+
+            await player.queue.put(track)
+            if ctx.interaction is not None:
+                # A slash command has to be answered, and its reply doesn't count against the channel's rate limit
+                embed = discord.Embed(title="", description=f"Queued [{track.title}]({track.webpage_url}) [{ctx.author.mention}]", color=discord.Color.green())
+                await ctx.send(embed=embed)
+            else:
+                # Songs queued in quick succession are announced together
+                self.outbox.queued(ctx.channel, track.title, track.webpage_url, ctx.author.mention)
+
+    @commands.hybrid_command(name="queue", aliases=['q', 'playlist'], description="Show the queued songs")
+    async def queue_(self, ctx: Context, page: int = 1) -> None:
+        player = self.players.get(ctx.guild.id)
+        if player is None or player.queue.empty():
+            embed = discord.Embed(title="", description="Nothing is queued.", color=discord.Color.green())
+            return await ctx.send(embed=embed)
+
+        pages = (player.queue.qsize() + QUEUE_PAGE_SIZE - 1) // QUEUE_PAGE_SIZE
+        page = max(1, min(page, pages))
+        lines = [f"`#{entry_id}` [{track.title}]({track.webpage_url})"
+                 for entry_id, track in player.queue.page((page - 1) * QUEUE_PAGE_SIZE, QUEUE_PAGE_SIZE)]
+        embed = discord.Embed(title=f"Queue ({player.queue.qsize()} songs)", description="\n".join(lines),
+                              color=discord.Color.green())
+        embed.set_footer(text=f"Page {page}/{pages}")
+        await ctx.send(embed=embed)
+
+    @commands.hybrid_command(name="remove", description="Remove a song from the queue by its #id")
+    async def remove(self, ctx: Context, entry: int) -> None:
+        player = self.players.get(ctx.guild.id)
+        try:
+            title, _ = player.remove(entry)
+        except (AttributeError, KeyError):
+            embed = discord.Embed(title="", description=f"There is no song `#{entry}` in the queue.", color=discord.Color.red())
+            return await ctx.send(embed=embed)
+        embed = discord.Embed(title="", description=f"Removed **{title}** [{ctx.author.mention}]", color=discord.Color.green())
+        await ctx.send(embed=embed)
+
+    @commands.hybrid_command(name="move", description="Move a song in front of another one, or to the end of the queue")
+    async def move(self, ctx: Context, entry: int, before: int = None) -> None:
+        player = self.players.get(ctx.guild.id)
+        try:
+            player.queue.move(entry, before=before)
+        except (AttributeError, KeyError):
+            embed = discord.Embed(title="", description="Both songs need to be in the queue.", color=discord.Color.red())
+            return await ctx.send(embed=embed)
+        embed = discord.Embed(title="", description=f"Moved `#{entry}` {f'in front of `#{before}`' if before else 'to the end'}", color=discord.Color.green())
+        await ctx.send(embed=embed)
+
+    @commands.hybrid_command(name="dedupe", description="Remove songs which are queued more than once")
+    async def dedupe(self, ctx: Context) -> None:
+        player = self.players.get(ctx.guild.id)
+        removed = player.queue.dedupe() if player else 0
+        embed = discord.Embed(title="", description=f"Removed {removed} duplicate song(s).", color=discord.Color.green())
+        await ctx.send(embed=embed)
+
+    @commands.hybrid_command(name="radio", description="Tune in to a stream along with every other server playing it")
+    async def radio(self, ctx: Context, *, url: str) -> None:
+        """Plays a stream right away as a shared broadcast: it is decoded once, however many servers listen to it.
+        Live streams played with /play are shared like this anyway."""
+        async with ctx.typing():
+            if not ctx.voice_client:
+                await ctx.invoke(self.connect_)
+
+            player = self.get_player(ctx)
+            data = await YTDLSource.extract_info(url, loop=self.bot.loop, guild_id=ctx.guild.id)
+            # Tune in now, the song that was playing is dropped
+            player.play_next(Track.from_info(data, ctx.author.id, broadcast=True))
+
+            listeners = YTDLSource.broadcasts.listeners(cache_key(data['webpage_url']))
+            embed = discord.Embed(title="", description=f"Tuning in to [{data['title']}]({data['webpage_url']}) "
+                                                        f"along with {listeners} other server(s) [{ctx.author.mention}]",
+                                  color=discord.Color.green())
+            await ctx.send(embed=embed)
+
+    @commands.hybrid_command(name="seek", description="Jump to a time in the current song, like 1:30")
+    async def seek(self, ctx: Context, position: str) -> None:
+        try:
+            seconds = util.parse_timestamp(position)
+        except ValueError:
+            embed = discord.Embed(title="", description=f"`{position}` isn't a time, try something like `1:30` or `90`.", color=discord.Color.red())
+            return await ctx.send(embed=embed)
+        await self.__seek(ctx, lambda current: seconds)
+
+    @commands.hybrid_command(name="rewind", description="Go back in the current song, 10 seconds unless told otherwise")
+    async def rewind(self, ctx: Context, seconds: int = 10) -> None:
+        await self.__seek(ctx, lambda current: current - seconds)
+
+    async def __seek(self, ctx, target):
+        player = self.players.get(ctx.guild.id)
+        if player is None or player.position is None:
+            embed = discord.Embed(title="", description="Nothing is playing.", color=discord.Color.red())
+            return await ctx.send(embed=embed)
+        try:
+            position = await player.seek(target(player.position))
+        except InvalidInputException as e:
+            embed = discord.Embed(title="", description=str(e), color=discord.Color.red())
+            return await ctx.send(embed=embed)
+        track = player.current_track
+        embed = discord.Embed(title="", description=f"Jumped to {util.format_timestamp(position)} in [{track.title}]({track.webpage_url}) [{ctx.author.mention}]", color=discord.Color.green())
         await ctx.send(embed=embed)
 
 
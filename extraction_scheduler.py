@@ -0,0 +1,125 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from enum import IntEnum
+from functools import partial
+
+import metrics
+
+logger = logging.getLogger("ytbot")
+
+# Jobs which sat in the queue for longer than this get logged
+SLOW_WAIT = 2.
+
+
+class Priority(IntEnum):
+    PLAYBACK = 0  # Needed to start playback now
+    PREFETCH = 1  # Resolving songs that are coming up soon
+    BACKGROUND = 2  # Filling in the rest of a playlist
+
+
+WAIT_SECONDS = metrics.histogram("ytbot_extraction_wait_seconds", "Time extractions spent waiting for a worker",
+                                 ("priority",))
+
+
+class _Job:
+    __slots__ = ('func', 'future', 'guild_id', 'priority', 'enqueued_at')
+
+    def __init__(self, func, future, guild_id, priority):
+        self.func = func
+        self.future = future
+        self.guild_id = guild_id
+        self.priority = priority
+        self.enqueued_at = time.monotonic()
+
+
+class ExtractionScheduler:
+    """Runs blocking yt_dlp work on a dedicated, bounded thread pool.
+
+    Jobs are picked by priority first. Within a priority every guild has its own queue and the guilds are
+    served round-robin, so one guild queuing a huge playlist can't starve everybody else.
+    All methods must be called from the event loop thread.
+    """
+
+    def __init__(self, workers: int = 4):
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ytdl")
+        self._running = 0
+        # One round-robin of guild_id -> deque of jobs per priority. The first guild is the next one served.
+        self._queues = [OrderedDict() for _ in Priority]
+
+        self.completed = 0
+        self.total_wait = 0.
+        self.max_wait = 0.
+
+    async def run(self, func, *, guild_id=None, priority: Priority = Priority.PLAYBACK):
+        """Schedules `func` and waits for its result. Cancelling the caller drops the job if it hasn't started."""
+        job = _Job(func, asyncio.get_running_loop().create_future(), guild_id, priority)
+        self._queues[priority].setdefault(guild_id, deque()).append(job)
+        self.__dispatch()
+        return await job.future
+
+    def depth(self, priority: Priority = None) -> int:
+        """Number of jobs waiting for a worker, optionally only at one priority."""
+        queues = self._queues if priority is None else [self._queues[priority]]
+        return sum(len(jobs) for guilds in queues for jobs in guilds.values())
+
+    def stats(self) -> dict:
+        return {
+            'running': self._running,
+            'queued': {p.name.lower(): self.depth(p) for p in Priority},
+            'guilds_waiting': len({g for guilds in self._queues for g in guilds}),
+            'completed': self.completed,
+            'avg_wait': self.total_wait / self.completed if self.completed else 0.,
+            'max_wait': self.max_wait,
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def __dispatch(self):
+        while self._running < self.workers:
+            job = self.__next_job()
+            if job is None:
+                return
+            if job.future.done():
+                continue  # The caller gave up while the job was queued
+
+            wait = time.monotonic() - job.enqueued_at
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            WAIT_SECONDS.observe(wait, priority=job.priority.name.lower())
+            if wait > SLOW_WAIT:
+                logger.debug(f"Extraction for guild {job.guild_id} waited {wait:.2f}s for a worker "
+                             f"({self.depth()} job(s) still queued)")
+
+            self._running += 1
+            future = asyncio.wrap_future(self._executor.submit(job.func))
+            future.add_done_callback(partial(self.__finished, job))
+
+    def __finished(self, job, future):
+        self._running -= 1
+        self.completed += 1
+        if not job.future.done():
+            if future.cancelled():
+                job.future.cancel()
+            elif future.exception() is not None:
+                job.future.set_exception(future.exception())
+            else:
+                job.future.set_result(future.result())
+        self.__dispatch()
+
+    def __next_job(self):
+        for guilds in self._queues:
+            if not guilds:
+                continue
+            guild_id, jobs = next(iter(guilds.items()))
+            job = jobs.popleft()
+            # Send the guild to the back of the line for this priority
+            del guilds[guild_id]
+            if jobs:
+                guilds[guild_id] = jobs
+            return job
+        return None
@@ -0,0 +1,196 @@
+"""
+Gapless playback. The voice client plays a GaplessSource for as long as songs keep coming, and the next song's ffmpeg
+is started and primed a few seconds before the current one ends, so the handoff happens between two frames instead of
+waiting for ffmpeg to start, probe and make its first network read.
+"""
+import collections
+import threading
+import time
+from array import array
+
+import discord
+
+import metrics
+from broadcast import FRAME_SECONDS
+
+HANDOFFS = metrics.counter("ytbot_gapless_handoffs_total", "Songs which started straight after the previous one")
+HANDOFF_SECONDS = metrics.histogram("ytbot_gapless_handoff_seconds",
+                                    "Time to read the first frame of the next song at a gapless handoff")
+
+
+class PrimedSource:
+    """Wraps a freshly spawned source, and reads its first `prebuffer` frames on a background thread, so that by the
+    time it is played ffmpeg is running and the start of the song is in memory.
+    Everything but reading is passed through to the wrapped source."""
+
+    def __init__(self, source, prebuffer: int = 25):
+        self.source = source
+        self._frames = collections.deque()
+        self._filled = threading.Event()
+        self._prebuffer = prebuffer
+        threading.Thread(target=self.__fill, name="gapless-prime", daemon=True).start()
+
+    def __fill(self):
+        try:
+            for _ in range(self._prebuffer):
+                frame = self.source.read()
+                if not frame:
+                    break
+                self._frames.append(frame)
+        finally:
+            self._filled.set()
+
+    @property
+    def ready(self) -> bool:
+        return self._filled.is_set()
+
+    @property
+    def position(self) -> float:
+        # The frames sitting in the prebuffer were counted by the source, but haven't been played
+        return self.source.position - len(self._frames) * FRAME_SECONDS
+
+    def read(self) -> bytes:
+        self._filled.wait()
+        if self._frames:
+            return self._frames.popleft()
+        return self.source.read()
+
+    def is_opus(self) -> bool:
+        return self.source.is_opus()
+
+    def cleanup(self):
+        self.source.cleanup()
+
+    def __getattr__(self, item):
+        return getattr(self.source, item)
+
+
+class GaplessSource(discord.AudioSource):
+    """Plays one song after another without the voice client stopping in between.
+
+    Once the current song is within `prime_seconds` of its duration, `on_near_end()` is called on the loop. A source for
+    the next song handed back through queue_next() is switched to within the same read() that finds the current one
+    finished, and `on_advance()` is called on the loop. With `crossfade` set (in PCM mode only), the two songs overlap
+    for that many seconds. The voice client only reaches the end of this source once a song ends with nothing queued
+    after it.
+
+    The sources are read on the voice client's thread. Changes made from the loop are only picked up at the start of
+    the next read, so a source is never cleaned up while it is being read.
+    """
+
+    def __init__(self, source, duration, *, loop, on_near_end, on_advance, prime_seconds: float = 5.,
+                 crossfade: float = 0.):
+        self.loop = loop
+        self.prime_seconds = prime_seconds
+        self.crossfade = 0. if source.is_opus() else crossfade
+        self._on_near_end = on_near_end
+        self._on_advance = on_advance
+
+        self.current = source
+        self._duration = duration
+        self._near_end_sent = False
+        self._next = None  # (source, duration)
+        self._replacement = None  # (source, duration) to swap in for the current song
+        self._discarded = []
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def queue_next(self, source, duration) -> bool:
+        """Plays `source` once the current song ends. Returns False if this has already stopped."""
+        with self._lock:
+            if self._closed:
+                return False
+            if self._next is not None:
+                self._discarded.append(self._next[0])
+            self._next = (source, duration)
+            return True
+
+    def drop_next(self):
+        """Takes back the source given to queue_next(), unless it has started playing. Returns whether it was dropped."""
+        with self._lock:
+            if self._next is None:
+                return False
+            self._discarded.append(self._next[0])
+            self._next = None
+            return True
+
+    def replace_current(self, source, duration=None):
+        """Swaps the current song's source for another, like one seeked to a different position."""
+        with self._lock:
+            if self._closed:
+                source.cleanup()
+                return
+            if self._replacement is not None:
+                self._discarded.append(self._replacement[0])
+            self._replacement = (source, duration if duration is not None else self._duration)
+
+    def read(self) -> bytes:
+        with self._lock:
+            discarded, self._discarded = self._discarded, []
+            if self._replacement is not None:
+                discarded.append(self.current)
+                (self.current, self._duration), self._replacement = self._replacement, None
+                self._near_end_sent = False
+            upcoming = self._next
+        for source in discarded:
+            source.cleanup()
+
+        data = self.current.read()
+        remaining = self._duration - self.current.position if self._duration else None
+
+        if remaining is not None and not self._near_end_sent and remaining <= self.prime_seconds:
+            self._near_end_sent = True
+            self.loop.call_soon_threadsafe(self._on_near_end)
+
+        if self.crossfade and data and upcoming is not None and remaining is not None and remaining <= self.crossfade:
+            if not upcoming[0].ready:
+                return data  # Not primed in time, play the next song from the start once this one ends instead
+            incoming = upcoming[0].read()
+            if incoming:
+                return self.__mix(data, incoming, max(0., remaining) / self.crossfade)
+
+        # A song which stops well before its end was cut off rather than finished, so end here and let the player
+        # decide what to do with it
+        if not data and upcoming is not None and remaining <= self.prime_seconds + 1:
+            return self.__advance(upcoming)
+        return data
+
+    def __advance(self, upcoming):
+        with self._lock:
+            if self._next is not upcoming:
+                return b''  # Dropped meanwhile
+            self._next = None
+            finished = self.current
+            self.current, self._duration = upcoming
+            self._near_end_sent = False
+        finished.cleanup()
+        start = time.perf_counter()
+        data = self.current.read()
+        HANDOFF_SECONDS.observe(time.perf_counter() - start)
+        HANDOFFS.inc()
+        self.loop.call_soon_threadsafe(self._on_advance)
+        return data
+
+    @staticmethod
+    def __mix(outgoing: bytes, incoming: bytes, outgoing_level: float) -> bytes:
+        # Linear crossfade. Both are 16 bit stereo PCM, the end of the outgoing song can be a short frame. A weighted
+        # average of two samples can't overflow, so there is nothing to clip
+        if len(outgoing) < len(incoming):
+            outgoing += b'\x00' * (len(incoming) - len(outgoing))
+        incoming_level = 1 - outgoing_level
+        return array('h', [int(a * outgoing_level + b * incoming_level)
+                           for a, b in zip(array('h', outgoing[:len(incoming)]), array('h', incoming))]).tobytes()
+
+    def is_opus(self) -> bool:
+        return self.current.is_opus()
+
+    def cleanup(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            sources = [self.current] + self._discarded + [s for s, _ in filter(None, (self._next, self._replacement))]
+            self._next = self._replacement = None
+            self._discarded = []
+        for source in sources:
+            source.cleanup()
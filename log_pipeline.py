@@ -0,0 +1,191 @@
+"""
+Logging that never does disk I/O on the event loop. Records are put on a bounded queue and written by a background
+thread in batches, to a file that is rotated by size. Debug records are rate limited per call site, and if the writer
+falls behind, records are dropped rather than the caller being made to wait.
+"""
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+
+import metrics
+
+RECORDS_DROPPED = metrics.counter("ytbot_log_records_dropped_total", "Log records dropped because the queue was full")
+RECORDS_SUPPRESSED = metrics.counter("ytbot_log_records_suppressed_total",
+                                     "Debug log records suppressed by the per call site rate limit")
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets through at most `rate` records per second from each line of code, with bursts of up to `burst`, for
+    records at or below `max_level`. The next record let through from a line says how many were suppressed."""
+
+    def __init__(self, rate: float = 5., burst: int = 20, max_level: int = logging.DEBUG):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.max_level = max_level
+        self._sites = {}  # (pathname, lineno) -> [tokens, last refill, suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > self.max_level:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            site = self._sites.get((record.pathname, record.lineno))
+            if site is None:
+                site = self._sites[(record.pathname, record.lineno)] = [float(self.burst), now, 0]
+            site[0] = min(float(self.burst), site[0] + (now - site[1]) * self.rate)
+            site[1] = now
+            if site[0] < 1:
+                site[2] += 1
+                RECORDS_SUPPRESSED.inc()
+                return False
+            site[0] -= 1
+            suppressed, site[2] = site[2], 0
+        if suppressed:
+            record.msg = f"{record.msg} [{suppressed} similar message(s) suppressed]"
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """A QueueHandler which drops records when the queue is full, instead of blocking the thread that logged."""
+
+    def prepare(self, record):
+        # Only resolve what can't safely be passed to another thread, formatting is left to the writer
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            RECORDS_DROPPED.inc()
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, for log shippers."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record, self.datefmt),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'module': record.module,
+            'line': record.lineno,
+            'thread': record.threadName,
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class BatchingWriter:
+    """Background thread that writes queued records to `path`, a batch at a time.
+
+    Each batch is formatted and written with a single write and flush. When the file grows past `max_bytes` it is
+    rotated to path.1, path.1 to path.2 and so on, keeping `backups` old files.
+    """
+
+    def __init__(self, log_queue: queue.Queue, path: str, formatter: logging.Formatter, max_bytes: int = 10 * 1024 ** 2,
+                 backups: int = 5, batch_size: int = 256, flush_interval: float = .5):
+        self.queue = log_queue
+        self.path = path
+        self.formatter = formatter
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._file = open(path, 'a', encoding='utf-8')
+        self._thread = threading.Thread(target=self.__run, name="log-writer", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self, timeout: float = 5.):
+        """Writes out everything that has been queued so far and stops the thread."""
+        if self._thread.is_alive():
+            try:
+                self.queue.put(None, timeout=timeout)
+            except queue.Full:
+                return
+            self._thread.join(timeout)
+
+    def __run(self):
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                try:
+                    batch.append(self.queue.get(timeout=max(0., deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                stopping = True
+                batch.pop()
+            if batch:
+                self.__write(batch)
+        self._file.close()
+
+    def __write(self, batch):
+        lines = []
+        for record in batch:
+            try:
+                lines.append(self.formatter.format(record))
+            except Exception:
+                lines.append(f"Failed to format log record from {record.pathname}:{record.lineno}")
+        try:
+            self._file.write('\n'.join(lines) + '\n')
+            self._file.flush()
+            if self.max_bytes and self._file.tell() >= self.max_bytes:
+                self.__rotate()
+        except OSError:
+            pass  # Nowhere left to report this
+
+    def __rotate(self):
+        self._file.close()
+        if self.backups > 0:
+            for i in range(self.backups - 1, 0, -1):
+                if os.path.exists(f"{self.path}.{i}"):
+                    os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+
+def setup(logger: logging.Logger, path: str, *, structured: bool = False, max_bytes: int = 10 * 1024 ** 2,
+          backups: int = 5, queue_size: int = 10000, debug_rate: float = 5., debug_burst: int = 20) -> BatchingWriter:
+    """Sends `logger`'s records to `path` through a background writer, and returns the writer.
+    Whatever is still queued is written out when the process exits."""
+    if structured:
+        formatter = JsonFormatter(datefmt='%Y-%m-%dT%H:%M:%S')
+    else:
+        formatter = logging.Formatter(fmt='%(asctime)s %(levelname)-8s %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+    log_queue = queue.Queue(maxsize=queue_size)
+    writer = BatchingWriter(log_queue, path, formatter, max_bytes=max_bytes, backups=backups).start()
+    handler = DroppingQueueHandler(log_queue)
+    handler.setLevel(logging.DEBUG)
+    if debug_rate:
+        handler.addFilter(RateLimitFilter(rate=debug_rate, burst=debug_burst))
+    logger.addHandler(handler)
+    atexit.register(writer.stop)
+
+    metrics.gauge("ytbot_log_queue_depth", "Log records waiting to be written").set_function(log_queue.qsize)
+    return writer
@@ -0,0 +1,121 @@
+import asyncio
+import collections
+import sys
+import threading
+import time
+import traceback
+
+import metrics
+
+LOOP_LAG_SECONDS = metrics.histogram("ytbot_loop_lag_seconds", "How late the event loop ran a timer",
+                                     buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1., 5.))
+LOOP_STALLS = metrics.counter("ytbot_loop_stalls_total", "Times the event loop was blocked past the stall threshold")
+
+
+class Stall:
+    __slots__ = ('started', 'duration', 'stack')
+
+    def __init__(self, started, duration, stack):
+        self.started = started  # Unix time
+        self.duration = duration
+        self.stack = stack  # Formatted stack of the loop thread while it was stuck, if the watchdog caught it
+
+
+class LoopLagMonitor:
+    """Watches the event loop for stalls.
+
+    A heartbeat task on the loop measures how late its timer fires. A watchdog thread notices when the heartbeat
+    hasn't run for longer than `threshold`, and grabs the loop thread's stack while it is still stuck, so each stall
+    is recorded together with whatever was blocking the loop.
+    """
+
+    def __init__(self, interval: float = .1, threshold: float = .25, history: int = 50):
+        self.interval = interval
+        self.threshold = threshold
+        self.stalls = collections.deque(maxlen=history)
+        self.max_lag = 0.
+
+        self._beat = time.monotonic()
+        self._stack = None
+        self._loop_thread = None
+        self._task = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        """Starts monitoring the running loop. Must be called from the loop thread."""
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.get_running_loop().create_task(self.__heartbeat())
+        threading.Thread(target=self.__watchdog, name="loop-watchdog", daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+
+    async def __heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self._beat = now
+
+            lag = max(0., now - expected)
+            LOOP_LAG_SECONDS.observe(lag)
+            self.max_lag = max(self.max_lag, lag)
+            if lag > self.threshold:
+                LOOP_STALLS.inc()
+                self.stalls.append(Stall(time.time() - lag, lag, self._stack))
+            self._stack = None
+
+    def __watchdog(self):
+        while not self._stopped.wait(self.threshold / 2):
+            if self._stack is not None or time.monotonic() - self._beat < self.threshold + self.interval:
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is not None:
+                self._stack = ''.join(traceback.format_stack(frame, limit=12))
+
+
+class SamplingProfiler:
+    """Samples the stacks of every thread in the process for a while, and counts which functions show up most.
+    Self counts are samples where a function was at the top of a stack, total counts are samples where it was
+    anywhere on it."""
+
+    def __init__(self, interval: float = .005, thread_ids=None):
+        self.interval = interval
+        self.thread_ids = thread_ids  # Only sample these threads, if set
+        self.samples = 0
+        self.self_counts = collections.Counter()
+        self.total_counts = collections.Counter()
+
+    def run(self, seconds: float):
+        """Samples for `seconds`. This blocks, so run it on its own thread."""
+        me = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me or (self.thread_ids is not None and thread_id not in self.thread_ids):
+                    continue
+                self.samples += 1
+                self.self_counts[self.__describe(frame)] += 1
+                seen = set()
+                while frame is not None:
+                    seen.add(self.__describe(frame))
+                    frame = frame.f_back
+                self.total_counts.update(seen)
+            time.sleep(self.interval)
+
+    def summary(self, top: int = 15) -> str:
+        if not self.samples:
+            return "No samples taken."
+        lines = [f"{self.samples} samples", f"{'self%':>6} {'total%':>6}  function"]
+        for name, count in self.self_counts.most_common(top):
+            lines.append(f"{count / self.samples:>6.1%} {self.total_counts[name] / self.samples:>6.1%}  {name}")
+        return '\n'.join(lines)
+
+    @staticmethod
+    def __describe(frame):
+        code = frame.f_code
+        return f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{code.co_firstlineno})"
@@ -0,0 +1,95 @@
+import asyncio
+import json
+import logging
+import os
+import re
+from typing import Optional
+
+logger = logging.getLogger("ytbot")
+
+
+class LoudnessNormalizer:
+    """Evens out the loudness of tracks with a per-track gain.
+
+    The first time a track plays it is analysed once in the background with ffmpeg's loudnorm filter, and the gain
+    that brings it to `target` LUFS is cached by video id in a json file. From then on the gain is applied as soon as
+    the track starts, at no extra cost. Tracks which haven't been analysed yet play without normalization.
+    """
+
+    def __init__(self, path: str, target: float = -14., max_gain_db: float = 10., workers: int = 1,
+                 analyse_seconds: Optional[float] = 180):
+        self.path = path
+        self.target = target
+        self.max_gain_db = max_gain_db
+        self.analyse_seconds = analyse_seconds
+
+        self._gains = {}  # video id -> gain in dB
+        self._pending = set()
+        self._semaphore = asyncio.Semaphore(workers)
+
+        try:
+            with open(path, 'r') as f:
+                self._gains = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def gain(self, video_id: str) -> Optional[float]:
+        """The linear gain for a track, or None if it hasn't been analysed yet."""
+        gain_db = self._gains.get(video_id)
+        return None if gain_db is None else 10 ** (gain_db / 20)
+
+    def schedule(self, video_id: str, source: str, http_headers: dict = None) -> None:
+        """Starts a background analysis of the track, unless it has been analysed already or is in progress."""
+        if not video_id or video_id in self._gains or video_id in self._pending:
+            return
+        self._pending.add(video_id)
+        asyncio.get_running_loop().create_task(self.__analyse(video_id, source, http_headers))
+
+    async def __analyse(self, video_id, source, http_headers):
+        try:
+            async with self._semaphore:
+                loudness = await self.__measure(source, http_headers)
+            if loudness is None:
+                return
+            gain_db = max(-self.max_gain_db, min(self.max_gain_db, self.target - loudness))
+            self._gains[video_id] = round(gain_db, 2)
+            logger.debug(f"Measured {loudness:.1f} LUFS for '{video_id}', gain {gain_db:+.1f} dB")
+            await asyncio.get_running_loop().run_in_executor(None, self.__save, dict(self._gains))
+        except Exception as e:
+            logger.warning(f"Loudness analysis failed for '{video_id}': {e}")
+        finally:
+            self._pending.discard(video_id)
+
+    async def __measure(self, source, http_headers):
+        args = ['ffmpeg', '-hide_banner', '-nostats']
+        if http_headers:
+            args += ['-headers', ''.join(f"{k}: {v}\r\n" for k, v in http_headers.items())]
+        args += ['-i', source]
+        if self.analyse_seconds:
+            args += ['-t', str(self.analyse_seconds)]
+        args += ['-vn', '-af', 'loudnorm=print_format=json', '-f', 'null', '-']
+
+        process = await asyncio.create_subprocess_exec(*args, stdin=asyncio.subprocess.DEVNULL,
+                                                       stdout=asyncio.subprocess.DEVNULL,
+                                                       stderr=asyncio.subprocess.PIPE)
+        _, stderr = await process.communicate()
+        if process.returncode != 0:
+            raise RuntimeError(f"ffmpeg exited with code {process.returncode}")
+
+        # loudnorm prints its measurements as the last json object on stderr
+        match = re.search(r"\{[^{}]*\"input_i\"[^{}]*\}", stderr.decode(errors='replace'))
+        if match is None:
+            return None
+        loudness = float(json.loads(match.group(0))['input_i'])
+        # Digital silence measures as -inf, don't try to normalize that
+        return loudness if loudness > -70 else None
+
+    def __save(self, gains):
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(tmp, 'w') as f:
+                json.dump(gains, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logger.warning(f"Failed to save loudness cache: {e}")
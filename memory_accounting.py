@@ -0,0 +1,104 @@
+import asyncio
+import gc
+import sys
+import time
+import types
+import weakref
+from collections import Counter
+
+# Objects of these types are shared by everything, so they are never charged to a guild
+_SHARED_TYPES = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.MethodType,
+                 types.CodeType, types.FrameType, weakref.ref, asyncio.AbstractEventLoop)
+
+
+def retained_size(root, shared_ids: set) -> (int, Counter):
+    """Sums the sizes of everything reachable from `root`, and breaks them down by type.
+
+    Traversal stops at objects in `shared_ids` and at shared types like modules and functions. discord.py models
+    (other than embeds) are charged for their own size only, since they point into the client's shared caches.
+    """
+    seen = set(shared_ids)
+    by_type = Counter()
+    total = 0
+    stack = [root]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, _SHARED_TYPES):
+            continue
+        seen.add(id(obj))
+
+        size = sys.getsizeof(obj, 0)
+        total += size
+        by_type[type(obj).__name__] += size
+
+        module = type(obj).__module__ or ''
+        if module.startswith('discord') and type(obj).__name__ != 'Embed':
+            continue
+        stack.extend(gc.get_referents(obj))
+    return total, by_type
+
+
+class MemoryAccountant:
+    """Attributes retained memory to guild players, diffs it between snapshots, and looks for players which
+    have outlived their voice connection or survived being destroyed."""
+
+    def __init__(self, grace: float = 60.):
+        self.grace = grace
+        self.previous = None
+        self._first_seen = {}  # guild id -> monotonic time the player was first seen without a voice client
+        self._destroyed = []  # (guild id, weakref to player, time destroyed)
+
+    def track_destroyed(self, guild_id, player):
+        """Remembers a player which has been cleaned up, so it can be reported if it never gets freed."""
+        self._destroyed.append((guild_id, weakref.ref(player), time.monotonic()))
+
+    async def snapshot(self, players: dict, shared: list) -> dict:
+        """Measures every player. Yields to the loop between guilds, so a big fleet doesn't stall playback."""
+        shared_ids = {id(obj) for obj in shared} | {id(players)}
+        guilds = {}
+        types_total = Counter()
+        for guild_id, player in list(players.items()):
+            size, by_type = retained_size(player, shared_ids)
+            guilds[guild_id] = {'bytes': size, 'types': by_type}
+            types_total.update(by_type)
+            await asyncio.sleep(0)
+
+        snapshot = {'time': time.time(), 'guilds': guilds, 'types': types_total,
+                    'total': sum(g['bytes'] for g in guilds.values())}
+        diff = self.__diff(self.previous, snapshot) if self.previous is not None else None
+        self.previous = snapshot
+        return {**snapshot, 'diff': diff}
+
+    def orphaned(self, players: dict) -> [int]:
+        """Guilds whose player has been without a voice connection for longer than the grace period."""
+        now = time.monotonic()
+        orphans = []
+        for guild_id, player in list(players.items()):
+            voice_client = player._guild.voice_client
+            if voice_client is not None and voice_client.is_connected():
+                self._first_seen.pop(guild_id, None)
+                continue
+            if now - self._first_seen.setdefault(guild_id, now) > self.grace:
+                orphans.append(guild_id)
+        for guild_id in set(self._first_seen) - set(players):
+            del self._first_seen[guild_id]
+        return orphans
+
+    def leaked(self) -> [int]:
+        """Guilds with a destroyed player that is still alive after a full collection."""
+        gc.collect()
+        now = time.monotonic()
+        self._destroyed = [(g, ref, t) for g, ref, t in self._destroyed if ref() is not None]
+        return [g for g, _, t in self._destroyed if now - t > self.grace]
+
+    @staticmethod
+    def __diff(old, new):
+        guilds = {g: new['guilds'][g]['bytes'] - old['guilds'].get(g, {'bytes': 0})['bytes'] for g in new['guilds']}
+        guilds.update({g: -old['guilds'][g]['bytes'] for g in old['guilds'] if g not in new['guilds']})
+        types_diff = Counter(new['types'])
+        types_diff.subtract(old['types'])
+        return {'seconds': new['time'] - old['time'], 'total': new['total'] - old['total'],
+                'guilds': guilds, 'types': types_diff}
+
+
+accountant = MemoryAccountant()
@@ -0,0 +1,187 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+from urllib.parse import urlparse, parse_qs
+
+
+# Fields of a yt_dlp info dict that stay valid for as long as the video exists.
+STATIC_FIELDS = ('id', 'title', 'webpage_url', 'duration', 'uploader', 'channel', 'thumbnail',
+                 'extractor', 'extractor_key', 'is_live')
+
+# Fields tied to a signed stream url. These are only usable until the url's `expire` timestamp.
+STREAM_FIELDS = ('url', 'http_headers', 'format_id', 'ext', 'acodec', 'abr', 'asr', 'protocol', 'filesize')
+
+_yt_id_regex = re.compile(r"(?:[?&]v=|youtu\.be/|/embed/|/shorts/|/v/)([\w\-]{11})")
+
+
+def cache_key(query: str) -> str:
+    """Canonical key for a query: the youtube video id when there is one, otherwise the query itself."""
+    match = _yt_id_regex.search(query)
+    return match.group(1) if match else query.strip()
+
+
+def stream_expiry(url: str, default_ttl: float) -> float:
+    """Returns the unix time at which a stream url stops working.
+    googlevideo urls carry it either as an `expire` query param or as an `/expire/<ts>/` path segment."""
+    parsed = urlparse(url)
+    expire = parse_qs(parsed.query).get('expire')
+    if expire:
+        return float(expire[0])
+    match = re.search(r"/expire/(\d+)", parsed.path)
+    if match:
+        return float(match.group(1))
+    return time.time() + default_ttl
+
+
+class _Entry:
+    __slots__ = ('static', 'stored_at', 'stream', 'stream_expires')
+
+    def __init__(self, static, stored_at):
+        self.static = static
+        self.stored_at = stored_at
+        self.stream = None
+        self.stream_expires = 0.
+
+
+class MetadataCache:
+    """Two-tier cache for yt_dlp info dicts.
+
+    The first tier is an in-memory LRU with a TTL. The second tier is an optional directory of json files,
+    which survives restarts. Static fields (title, duration, ...) and stream fields (the signed url and its
+    headers) are stored apart, because the stream fields expire long before the static ones do.
+    Only static fields are ever written to disk.
+    """
+
+    def __init__(self, max_entries: int = 512, ttl: float = 6 * 3600, path: Optional[str] = None,
+                 stream_ttl: float = 300, stream_margin: float = 60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.stream_ttl = stream_ttl
+        self.stream_margin = stream_margin
+
+        self.hits = 0
+        self.misses = 0
+        self.stream_hits = 0
+        self.stream_misses = 0
+        self.disk_hits = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        if path:
+            os.makedirs(path, exist_ok=True)
+
+    def get(self, key: str, *, need_stream: bool = False, valid_until: float = None) -> Optional[dict]:
+        """Looks up an info dict in memory.
+        If `need_stream` is set, a hit also requires a stream url that is still valid at `valid_until`."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or now - entry.stored_at > self.ttl:
+                if entry is not None:
+                    del self._entries[key]
+                if need_stream:
+                    self.stream_misses += 1
+                else:
+                    self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            if not need_stream:
+                self.hits += 1
+                return dict(entry.static)
+
+            if entry.stream is None or entry.stream_expires - self.stream_margin < (valid_until or now):
+                self.stream_misses += 1
+                return None
+            self.stream_hits += 1
+            return {**entry.static, **entry.stream}
+
+    def load(self, key: str) -> Optional[dict]:
+        """Looks up the static fields of an info dict on disk, promoting them to memory on a hit.
+        This does blocking file I/O, so call it from an executor."""
+        if not self.path:
+            return None
+        try:
+            with open(self.__disk_path(key), 'r') as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if time.time() - record['stored_at'] > self.ttl:
+            return None
+
+        with self._lock:
+            self.disk_hits += 1
+            if key not in self._entries:
+                self.__insert(key, _Entry(record['static'], record['stored_at']))
+        return dict(record['static'])
+
+    def put(self, key: str, data: dict) -> None:
+        """Stores an info dict, splitting it into its static and stream fields.
+        Also does blocking file I/O when the disk tier is enabled."""
+        now = time.time()
+        static = {k: data[k] for k in STATIC_FIELDS if k in data}
+        entry = _Entry(static, now)
+        if data.get('url'):
+            entry.stream = {k: data[k] for k in STREAM_FIELDS if k in data}
+            entry.stream_expires = stream_expiry(data['url'], self.stream_ttl)
+
+        with self._lock:
+            self.__insert(key, entry)
+
+        if self.path:
+            tmp = f"{self.__disk_path(key)}.{os.getpid()}.tmp"
+            try:
+                with open(tmp, 'w') as f:
+                    json.dump({'stored_at': now, 'static': static}, f)
+                os.replace(tmp, self.__disk_path(key))
+            except OSError:
+                pass  # The disk tier is best-effort
+
+    def stream_expires_at(self, key: str) -> float:
+        """Unix time at which the cached stream url for `key` expires, or 0 if there is none."""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry.stream_expires if entry is not None and entry.stream is not None else 0.
+
+    def peek(self, key: str) -> Optional[dict]:
+        """The cached info dict with its stream fields, if it has an unexpired stream url. Unlike get(), this isn't
+        counted as a lookup and doesn't refresh the entry."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.stream is None or entry.stream_expires < time.time():
+                return None
+            return {**entry.static, **entry.stream}
+
+    def invalidate_stream(self, key: str) -> None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.stream = None
+                entry.stream_expires = 0.
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'stream_hits': self.stream_hits,
+            'stream_misses': self.stream_misses,
+            'disk_hits': self.disk_hits,
+            'size': len(self._entries),
+        }
+
+    def __insert(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def __disk_path(self, key):
+        return os.path.join(self.path, f"{hashlib.sha1(key.encode()).hexdigest()}.json")
@@ -0,0 +1,216 @@
+"""
+Outgoing chat messages which aren't direct replies to a command. Bursts are coalesced, so a playlist or a busy guild
+posts one summary instead of a message per song, and sends are paced to stay inside discord's rate limits rather than
+running into them and holding up command responses.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+import discord
+
+import metrics
+
+logger = logging.getLogger("ytbot")
+
+MESSAGES = metrics.counter("ytbot_outbox_messages_total", "Messages sent or edited by the outbox", ("kind", "action"))
+COALESCED = metrics.counter("ytbot_outbox_coalesced_total",
+                            "Notifications merged into a message that was already waiting to be sent", ("kind",))
+SEND_DELAY = metrics.histogram("ytbot_outbox_delay_seconds", "Time from a notification to its message being sent")
+
+# How many songs a "Queued" summary lists before it just gives a count
+SUMMARY_LINES = 10
+
+
+class RateWindow:
+    """Allows at most `limit` calls in any `per` seconds, the way discord's rate limit buckets count requests."""
+
+    def __init__(self, limit: int, per: float):
+        self.limit = limit
+        self.per = per
+        self._calls = deque()
+
+    def __len__(self):
+        """Calls made in the last `per` seconds."""
+        now = time.monotonic()
+        while self._calls and now - self._calls[0] >= self.per:
+            self._calls.popleft()
+        return len(self._calls)
+
+    def delay(self) -> float:
+        """Seconds until a call can be made."""
+        return 0. if len(self) < self.limit else self._calls[0] + self.per - time.monotonic()
+
+    def take(self) -> None:
+        self._calls.append(time.monotonic())
+
+
+class Transport:
+    """How messages get to discord. Swap it for a local stand-in to run without the HTTP API."""
+
+    async def send(self, channel, *, content=None, embed=None):
+        return await channel.send(content, embed=embed)
+
+    async def edit(self, message, *, content=None, embed=None):
+        return await message.edit(content=content, embed=embed)
+
+
+class _Item:
+    __slots__ = ('kind', 'entries', 'future', 'ready_at', 'created_at', 'previous')
+
+    def __init__(self, kind, entry, future, ready_at, previous=None):
+        self.kind = kind
+        self.entries = [entry]
+        self.future = future
+        self.ready_at = ready_at
+        self.created_at = time.monotonic()
+        self.previous = previous  # Message to edit rather than posting a new one
+
+
+class _Channel:
+    __slots__ = ('channel', 'window', 'items', 'task')
+
+    def __init__(self, channel, window):
+        self.channel = channel
+        self.window = window
+        self.items = deque()
+        self.task = None
+
+
+class Outbox:
+    """Queues messages per channel and sends them in order, at most `limit` every `per` seconds in each channel and
+    `global_limit` a second across all of them.
+
+    "Queued" notifications and song errors are held for `window` seconds and merged with any others for the same
+    channel that are still waiting, into a single summary. A "Now playing" update replaces one that hasn't been sent
+    yet, and edits the previous "Now playing" message unless that is more than `edit_max_age` seconds old.
+    Every method returns a future for the message that ends up carrying the notification, or None if it couldn't be
+    sent. A channel only has a task while it has something waiting.
+    """
+
+    def __init__(self, transport: Transport = None, *, limit: int = 5, per: float = 5., global_limit: int = 40,
+                 window: float = .5, edit_max_age: float = 600.):
+        self.transport = transport or Transport()
+        self.limit = limit
+        self.per = per
+        self.window = window
+        self.edit_max_age = edit_max_age
+        self._global = RateWindow(global_limit, 1.)
+        self._channels = {}  # channel id -> _Channel
+        self._windows = {}  # channel id -> RateWindow still counting calls, for channels with nothing waiting
+
+        metrics.gauge("ytbot_outbox_pending", "Messages waiting to be sent").set_function(
+            lambda: sum(len(state.items) for state in list(self._channels.values())))
+
+    def send(self, channel, content: str = None, *, embed: discord.Embed = None) -> asyncio.Future:
+        return self.__add(channel, 'message', (content, embed), merge=False)
+
+    def queued(self, channel, title: str, url: str, mention: str) -> asyncio.Future:
+        return self.__add(channel, 'queued', (title, url, mention), merge=True, delay=self.window)
+
+    def error(self, channel, error) -> asyncio.Future:
+        return self.__add(channel, 'error', str(error), merge=True, delay=self.window)
+
+    def now_playing(self, channel, embed: discord.Embed, previous=None) -> asyncio.Future:
+        return self.__add(channel, 'now_playing', embed, merge=False, replace=True, previous=previous)
+
+    def __add(self, channel, kind, entry, *, merge, replace=False, delay=0., previous=None):
+        state = self._channels.get(channel.id)
+        if state is None:
+            window = self._windows.pop(channel.id, None) or RateWindow(self.limit, self.per)
+            state = self._channels[channel.id] = _Channel(channel, window)
+
+        for item in state.items:
+            if item.kind != kind:
+                continue
+            if merge:
+                item.entries.append(entry)
+            elif replace:
+                item.entries = [entry]
+            else:
+                continue
+            COALESCED.inc(kind=kind)
+            return item.future
+
+        future = asyncio.get_running_loop().create_future()
+        state.items.append(_Item(kind, entry, future, time.monotonic() + delay, previous))
+        if state.task is None:
+            state.task = asyncio.get_running_loop().create_task(self.__drain(state))
+        return future
+
+    async def __drain(self, state):
+        try:
+            while state.items:
+                item = state.items[0]
+                wait = max(item.ready_at - time.monotonic(), state.window.delay(), self._global.delay())
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    continue
+                # Taken off the queue before sending, so nothing more gets merged into it
+                state.items.popleft()
+                self._global.take()
+                SEND_DELAY.observe(time.monotonic() - item.created_at)
+                try:
+                    message = await self.__deliver(state.channel, item)
+                except Exception as e:
+                    logger.warning(f"Failed to send {item.kind} message to channel {state.channel.id}: {e}")
+                    message = None
+                # Counted from the response, which can't be earlier than discord counted the request
+                state.window.take()
+                if not item.future.done():
+                    item.future.set_result(message)
+        finally:
+            state.task = None
+            for item in state.items:
+                if not item.future.done():
+                    item.future.set_result(None)
+            if self._channels.get(state.channel.id) is state:
+                del self._channels[state.channel.id]
+                self._windows = {channel_id: window for channel_id, window in self._windows.items() if len(window)}
+                if len(state.window):
+                    self._windows[state.channel.id] = state.window
+
+    async def __deliver(self, channel, item):
+        if item.kind == 'now_playing':
+            embed = item.entries[0]
+            if item.previous is not None and self.__editable(item.previous):
+                try:
+                    message = await self.transport.edit(item.previous, embed=embed)
+                    MESSAGES.inc(kind=item.kind, action="edit")
+                    return message or item.previous
+                except discord.HTTPException:
+                    pass  # Deleted, post a new one
+            content = None
+        elif item.kind == 'queued':
+            embed = self.__queued_embed(item.entries)
+            content = None
+        elif item.kind == 'error':
+            embed = None
+            errors = "\n".join(f"[{e}]" for e in item.entries)
+            content = ('There was an error processing your song.\n' if len(item.entries) == 1 else
+                       f'There were errors processing {len(item.entries)} songs.\n') + f'```css\n{errors}\n```'
+        else:
+            content, embed = item.entries[0]
+        message = await self.transport.send(channel, content=content, embed=embed)
+        MESSAGES.inc(kind=item.kind, action="send")
+        return message
+
+    def __editable(self, message) -> bool:
+        created_at = getattr(message, 'created_at', None)
+        if created_at is None:
+            return True
+        return (datetime.now(timezone.utc) - created_at).total_seconds() < self.edit_max_age
+
+    @staticmethod
+    def __queued_embed(entries) -> discord.Embed:
+        if len(entries) == 1:
+            title, url, mention = entries[0]
+            return discord.Embed(title="", description=f"Queued [{title}]({url}) [{mention}]",
+                                 color=discord.Color.green())
+        lines = [f"[{title}]({url}) [{mention}]" for title, url, mention in entries[:SUMMARY_LINES]]
+        if len(entries) > SUMMARY_LINES:
+            lines.append(f"and {len(entries) - SUMMARY_LINES} more")
+        return discord.Embed(title=f"Queued {len(entries)} songs", description="\n".join(lines),
+                             color=discord.Color.green())
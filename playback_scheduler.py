@@ -0,0 +1,236 @@
+"""
+Drives every guild's playback from one place. A player has no task of its own while a song is playing or while it is
+idle: songs are started by short lived transitions, kicked off when something is queued or when the voice client
+reports the previous song finished, and idle players are reclaimed by a single timer wheel.
+"""
+import logging
+import math
+from enum import Enum
+
+import metrics
+
+logger = logging.getLogger("ytbot")
+
+PLAYERS_BY_STATE = metrics.gauge("ytbot_players_by_state", "Guild players in each playback state", ("state",))
+
+
+class PlaybackState(Enum):
+    IDLE = 1  # Nothing playing, waiting for a song to be queued
+    STARTING = 2  # Taking the next song off the queue and resolving its stream
+    PLAYING = 3
+
+
+class _Timer:
+    __slots__ = ('callback', 'rounds', 'slot')
+
+    def __init__(self, callback, rounds, slot):
+        self.callback = callback
+        self.rounds = rounds
+        self.slot = slot
+
+
+class TimerWheel:
+    """A hashed timing wheel: many coarse timers, driven by a single loop callback.
+
+    Timers are put in one of `slots` buckets by their expiry tick, and every `tick` seconds the bucket under the cursor
+    is checked, so scheduling and cancelling are O(1) whatever the number of timers. Timers further out than one turn
+    of the wheel wait a number of turns in their bucket. Nothing runs while there are no timers.
+    """
+
+    def __init__(self, loop, tick: float = 1., slots: int = 512):
+        self.loop = loop
+        self.tick = tick
+        self._slots = [set() for _ in range(slots)]
+        self._cursor = 0
+        self._count = 0
+        self._handle = None
+        self._next_tick = None
+
+    def __len__(self):
+        return self._count
+
+    def schedule(self, delay: float, callback) -> _Timer:
+        """Calls `callback()` on the loop after roughly `delay` seconds, give or take a tick."""
+        ticks = max(1, math.ceil(delay / self.tick))
+        slot = (self._cursor + ticks) % len(self._slots)
+        timer = _Timer(callback, (ticks - 1) // len(self._slots), slot)
+        self._slots[slot].add(timer)
+        self._count += 1
+        if self._handle is None:
+            self._next_tick = self.loop.time() + self.tick
+            self._handle = self.loop.call_at(self._next_tick, self.__advance)
+        return timer
+
+    def cancel(self, timer: _Timer) -> None:
+        if timer.slot is not None and timer in self._slots[timer.slot]:
+            self._slots[timer.slot].discard(timer)
+            self._count -= 1
+        timer.slot = None
+
+    def stop(self) -> None:
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        for slot in self._slots:
+            slot.clear()
+        self._count = 0
+
+    def __advance(self):
+        self._cursor = (self._cursor + 1) % len(self._slots)
+        expired = []
+        for timer in list(self._slots[self._cursor]):
+            if timer.rounds > 0:
+                timer.rounds -= 1
+            else:
+                self._slots[self._cursor].discard(timer)
+                self._count -= 1
+                timer.slot = None
+                expired.append(timer)
+
+        if self._count:
+            # Scheduled on a fixed grid, so slow callbacks don't make the wheel drift
+            self._next_tick += self.tick
+            self._handle = self.loop.call_at(max(self._next_tick, self.loop.time()), self.__advance)
+        else:
+            self._handle = None
+
+        for timer in expired:
+            try:
+                timer.callback()
+            except Exception as e:
+                logger.error(f"Timer callback failed: {e}")
+
+
+class PlaybackScheduler:
+    """The playback state machine of every guild player.
+
+    A player is IDLE until a song is queued, STARTING while its next song is taken off the queue and its stream
+    resolved, and PLAYING until the voice client calls back to say the song ended. Only the STARTING state has a task.
+    A player that stays IDLE for `idle_timeout` seconds is destroyed, which disconnects it.
+    """
+
+    def __init__(self, loop, idle_timeout: float = 300.):
+        self.loop = loop
+        self.idle_timeout = idle_timeout
+        self.wheel = TimerWheel(loop)
+        self._players = {}  # guild id -> player
+        self._states = {}  # guild id -> PlaybackState
+        self._transitions = {}  # guild id -> task starting the next song
+        self._idle_timers = {}  # guild id -> timer that reclaims the player
+
+        PLAYERS_BY_STATE.set_function(lambda: {(state.name.lower(),): sum(1 for s in list(self._states.values())
+                                                                           if s is state)
+                                               for state in PlaybackState})
+
+    def __len__(self):
+        return len(self._players)
+
+    def state(self, guild_id) -> PlaybackState:
+        return self._states.get(guild_id, PlaybackState.IDLE)
+
+    def register(self, player) -> None:
+        guild_id = player.guild_id
+        self._players[guild_id] = player
+        self._states[guild_id] = PlaybackState.IDLE
+        if player.queue.empty():
+            self.__arm_idle_timer(guild_id)
+        else:
+            self.wake(guild_id)
+
+    def unregister(self, guild_id) -> None:
+        self._players.pop(guild_id, None)
+        self._states.pop(guild_id, None)
+        self.__disarm_idle_timer(guild_id)
+        task = self._transitions.pop(guild_id, None)
+        if task is not None:
+            task.cancel()
+
+    def wake(self, guild_id) -> None:
+        """Called when a song is queued. Starts it if the player is idle."""
+        if guild_id not in self._players:
+            return
+        self.__disarm_idle_timer(guild_id)
+        if self._states[guild_id] is PlaybackState.IDLE:
+            self.__start_next(guild_id)
+
+    def song_ended(self, guild_id, error=None) -> None:
+        """Called on the loop once the voice client has finished with the current song, or it was skipped."""
+        player = self._players.get(guild_id)
+        if player is None or self._states[guild_id] is not PlaybackState.PLAYING:
+            return
+        if error is not None:
+            logger.warning(f"Song in guild {guild_id} stopped with an error: {error}")
+        player.finish_song(error)
+        self._states[guild_id] = PlaybackState.IDLE
+        if player.queue.empty():
+            self.__arm_idle_timer(guild_id)
+        else:
+            self.__start_next(guild_id)
+
+    def after_callback(self, guild_id):
+        """The `after` callback for voice_client.play(), which is called from the voice client's thread."""
+        return lambda error: self.loop.call_soon_threadsafe(self.song_ended, guild_id, error)
+
+    def stop(self) -> None:
+        for guild_id in list(self._players):
+            self.unregister(guild_id)
+        self.wheel.stop()
+
+    def __start_next(self, guild_id):
+        self._states[guild_id] = PlaybackState.STARTING
+        task = self.loop.create_task(self.__transition(guild_id))
+        self._transitions[guild_id] = task
+        task.add_done_callback(lambda t: self.__started(guild_id, t))
+
+    async def __transition(self, guild_id) -> bool:
+        player = self._players[guild_id]
+        source = await player.next_source()
+        if source is None:
+            return False
+        # PLAYING before play(), since a song that fails straight away calls back before play() even returns
+        self._states[guild_id] = PlaybackState.PLAYING
+        try:
+            player.play(source, after=self.after_callback(guild_id))
+        except Exception:
+            self._states[guild_id] = PlaybackState.STARTING
+            source.cleanup()
+            raise
+        await player.announce(source)
+        return True
+
+    def __started(self, guild_id, task):
+        if self._transitions.get(guild_id) is not task:
+            return  # Cancelled, or the song already ended and the next transition has taken over
+        del self._transitions[guild_id]
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error is not None:
+            logger.error(f"Failed to start the next song in guild {guild_id}: {error}")
+        if self._states.get(guild_id) is not PlaybackState.STARTING:
+            return
+        # Nothing could be played, wait for the next song to be queued
+        self._states[guild_id] = PlaybackState.IDLE
+        self.__arm_idle_timer(guild_id)
+
+    def __arm_idle_timer(self, guild_id):
+        self.__disarm_idle_timer(guild_id)
+        self._idle_timers[guild_id] = self.wheel.schedule(self.idle_timeout, lambda: self.__reclaim(guild_id))
+
+    def __disarm_idle_timer(self, guild_id):
+        timer = self._idle_timers.pop(guild_id, None)
+        if timer is not None:
+            self.wheel.cancel(timer)
+
+    def __reclaim(self, guild_id):
+        self._idle_timers.pop(guild_id, None)
+        player = self._players.get(guild_id)
+        if player is None or self._states[guild_id] is not PlaybackState.IDLE:
+            return
+        # A player whose voice client is gone can't play what is left in its queue
+        if player.queue.empty() or player.guild.voice_client is None:
+            logger.debug(f"Player in guild {guild_id} was idle for {self.idle_timeout:.0f}s, disconnecting")
+            self.unregister(guild_id)
+            player.destroy(player.guild)
+        else:
+            self.__arm_idle_timer(guild_id)
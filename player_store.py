@@ -0,0 +1,84 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class PlayerStore:
+    """Checkpoints of guild players in SQLite, so queues survive a restart.
+
+    Each guild is one row, holding its channels, volume, current track and queue as JSON. A row is only rewritten
+    when its contents change; how far into the current track playback got is worked out from the time the track
+    started and the last heartbeat of the process which owned it. Shard workers can share one database.
+    Every method blocks on disk, so call them from an executor.
+    """
+
+    def __init__(self, path: str, worker: str = "main", max_age: float = 24 * 3600):
+        self.path = path
+        self.worker = worker
+        self.max_age = max_age  # Checkpoints older than this aren't restored
+        self._saved = {}  # guild id -> state last written, so unchanged players are skipped
+        self._lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        with self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS players ("
+                             "guild_id INTEGER PRIMARY KEY, worker TEXT NOT NULL, saved_at REAL NOT NULL, "
+                             "state TEXT NOT NULL)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS heartbeats (worker TEXT PRIMARY KEY, alive_at REAL NOT NULL)")
+
+    def save(self, checkpoints: dict) -> int:
+        """Writes the checkpoints (guild id -> state) which changed since they were last written, and records a
+        heartbeat for this worker. Rows this worker wrote for guilds which no longer have a checkpoint, like a player
+        whose queue ran out, are deleted. Returns the number of players written."""
+        now = time.time()
+        with self._lock:
+            rows = []
+            for guild_id, state in checkpoints.items():
+                encoded = json.dumps(state, sort_keys=True)
+                if self._saved.get(guild_id) != encoded:
+                    rows.append((guild_id, self.worker, now, encoded))
+            with self._db:
+                stale = [(guild_id,) for guild_id, in self._db.execute(
+                    "SELECT guild_id FROM players WHERE worker = ?", (self.worker,)) if guild_id not in checkpoints]
+                self._db.executemany("DELETE FROM players WHERE guild_id = ?", stale)
+                self._db.executemany("INSERT OR REPLACE INTO players VALUES (?, ?, ?, ?)", rows)
+                self._db.execute("INSERT OR REPLACE INTO heartbeats VALUES (?, ?)", (self.worker, now))
+            self._saved = {guild_id: encoded for guild_id, encoded in self._saved.items() if guild_id in checkpoints}
+            for guild_id, _, _, encoded in rows:
+                self._saved[guild_id] = encoded
+        return len(rows)
+
+    def delete(self, guild_id: int) -> None:
+        with self._lock:
+            self._saved.pop(guild_id, None)
+            with self._db:
+                self._db.execute("DELETE FROM players WHERE guild_id = ?", (guild_id,))
+
+    def load(self, guild_ids) -> [(int, dict, float)]:
+        """Returns (guild id, state, time its worker was last alive) for each checkpoint of the given guilds which
+        is recent enough to be worth restoring."""
+        guild_ids = list(guild_ids)
+        now = time.time()
+        restored = []
+        with self._lock:
+            for i in range(0, len(guild_ids), 500):
+                chunk = guild_ids[i:i + 500]
+                rows = self._db.execute(
+                    f"SELECT p.guild_id, p.state, p.saved_at, h.alive_at FROM players p "
+                    f"LEFT JOIN heartbeats h ON h.worker = p.worker "
+                    f"WHERE p.guild_id IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+                for guild_id, state, saved_at, alive_at in rows:
+                    alive_at = max(saved_at, alive_at or 0)
+                    if now - alive_at <= self.max_age:
+                        restored.append((guild_id, json.loads(state), alive_at))
+                        self._saved[guild_id] = state
+        return restored
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
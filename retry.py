@@ -0,0 +1,197 @@
+"""
+Retries with exponential backoff and full jitter, a process-wide retry budget, and circuit breakers, so that when
+youtube starts throttling us every guild doesn't retry in lockstep and make it worse.
+"""
+import asyncio
+import logging
+import random
+import re
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger("ytbot")
+
+RETRIES = metrics.counter("ytbot_retries_total", "Calls retried after a retryable error", ("name",))
+RETRIES_DENIED = metrics.counter("ytbot_retries_denied_total", "Retries skipped because the retry budget ran out",
+                                 ("name",))
+CIRCUIT_STATE = metrics.gauge("ytbot_circuit_state", "Circuit breaker state: 0 closed, 1 half open, 2 open", ("name",))
+CIRCUIT_REJECTED = metrics.counter("ytbot_circuit_rejected_total", "Calls rejected by an open circuit breaker",
+                                   ("name",))
+
+# Messages of yt_dlp errors which are worth trying again: throttling, server errors and network trouble
+_RETRYABLE_MESSAGES = re.compile(
+    r"HTTP Error (429|5\d\d)|timed out|timeout|temporary failure|connection (reset|refused|aborted)|"
+    r"remote end closed|unable to download (webpage|api page)|read error|incomplete read", re.IGNORECASE)
+
+
+def backoff(attempt: int, base: float = .5, cap: float = 8.) -> float:
+    """Delay before retry number `attempt` (from 0), with full jitter: uniformly random up to base * 2^attempt."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Whether an error is likely to go away if the call is made again.
+    Errors yt_dlp expects, like a private or removed video, are not. Neither is anything that isn't I/O."""
+    if isinstance(error, CircuitOpenError):
+        return False
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError, ConnectionError)):
+        return True
+    # yt_dlp's DownloadError wraps the error that caused it
+    cause = getattr(error, 'exc_info', None)
+    if cause and cause[1] is not None and cause[1] is not error and is_retryable(cause[1]):
+        return True
+    if getattr(error, 'expected', False):
+        return False
+    if type(error).__name__ in ('DownloadError', 'ExtractorError', 'HTTPError', 'URLError', 'TransportError'):
+        return _RETRYABLE_MESSAGES.search(str(error)) is not None
+    return isinstance(error, OSError)
+
+
+class RetryBudget:
+    """Caps retries to a fraction of calls, so retries can't multiply the load on a struggling service.
+    Every call deposits `ratio` of a token and every retry withdraws a whole one. `min_per_second` tokens are added
+    each second regardless, so occasional failures can still be retried when traffic is low."""
+
+    def __init__(self, ratio: float = .2, min_per_second: float = 1., max_tokens: float = 20.):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self._tokens = max_tokens
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.__refill()
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            self.__refill()
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+    def __refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.max_tokens, self._tokens + (now - self._updated) * self.min_per_second)
+        self._updated = now
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, name: str, retry_in: float):
+        super().__init__(f"{name} is failing, not trying again for another {retry_in:.0f}s")
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """Stops calling a service that keeps failing, and gives it time to recover.
+
+    The circuit opens once `failure_threshold` failures happen within `window` seconds with no success in between.
+    While it's open calls fail straight away with CircuitOpenError. After `reset_timeout` seconds it goes half open
+    and lets a single trial call through: a success closes it again, a failure reopens it.
+    """
+    CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+    _NAMES = {CLOSED: "closed", HALF_OPEN: "half open", OPEN: "open"}
+
+    def __init__(self, name: str, failure_threshold: int = 5, window: float = 30., reset_timeout: float = 30.):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.window = window
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = []  # monotonic times of recent failures
+        self._opened_at = 0.
+        self._trial_running = False
+        self._lock = threading.Lock()
+        CIRCUIT_STATE.set(self.CLOSED, name=name)
+
+    def allow(self) -> None:
+        """Raises CircuitOpenError if the call shouldn't be made."""
+        with self._lock:
+            if self.state == self.OPEN:
+                retry_in = self._opened_at + self.reset_timeout - time.monotonic()
+                if retry_in > 0:
+                    CIRCUIT_REJECTED.inc(name=self.name)
+                    raise CircuitOpenError(self.name, retry_in)
+                self.__transition(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN:
+                if self._trial_running:
+                    CIRCUIT_REJECTED.inc(name=self.name)
+                    raise CircuitOpenError(self.name, self.reset_timeout)
+                self._trial_running = True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures.clear()
+            self._trial_running = False
+            if self.state != self.CLOSED:
+                self.__transition(self.CLOSED)
+
+    def record_failure(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            self._trial_running = False
+            if self.state == self.HALF_OPEN:
+                self._opened_at = now
+                self.__transition(self.OPEN)
+                return
+            self._failures = [t for t in self._failures if now - t < self.window] + [now]
+            if self.state == self.CLOSED and len(self._failures) >= self.failure_threshold:
+                self._opened_at = now
+                self.__transition(self.OPEN)
+
+    def release(self) -> None:
+        """Ends a call that neither succeeded nor failed in a way that says anything about the service."""
+        with self._lock:
+            self._trial_running = False
+
+    def __transition(self, state):
+        log = logger.warning if state == self.OPEN else logger.info
+        log(f"Circuit {self.name} went from {self._NAMES[self.state]} to {self._NAMES[state]}"
+            + (f" after {len(self._failures)} failure(s), pausing for {self.reset_timeout:.0f}s"
+               if state == self.OPEN else ""))
+        self.state = state
+        CIRCUIT_STATE.set(state, name=self.name)
+
+
+async def retry(func, *, name: str = "call", attempts: int = 3, retryable=is_retryable, budget: RetryBudget = None,
+                breaker: CircuitBreaker = None, base: float = .5, cap: float = 8.):
+    """Awaits `func()` until it succeeds, making at most `attempts` attempts.
+    Only errors `retryable` accepts are retried, after a jittered exponential backoff, and only while `budget` has
+    retries left. Retryable errors count as failures for `breaker`, which can refuse calls outright."""
+    if budget is not None:
+        budget.deposit()
+    for attempt in range(attempts):
+        if breaker is not None:
+            breaker.allow()
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            if breaker is not None:
+                breaker.release()
+            raise
+        except Exception as e:
+            can_retry = retryable(e)
+            if breaker is not None:
+                if can_retry:
+                    breaker.record_failure()
+                else:
+                    # The service answered, the answer just wasn't what we wanted
+                    breaker.record_success()
+            if not can_retry or attempt == attempts - 1:
+                raise
+            if budget is not None and not budget.withdraw():
+                RETRIES_DENIED.inc(name=name)
+                raise
+            delay = backoff(attempt, base, cap)
+            RETRIES.inc(name=name)
+            logger.debug(f"Retrying {name} in {delay:.2f}s after attempt {attempt + 1} failed: {e}")
+            await asyncio.sleep(delay)
+        else:
+            if breaker is not None:
+                breaker.record_success()
+            return result
@@ -0,0 +1,122 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from difflib import SequenceMatcher
+from typing import Optional
+
+# Words that say nothing about which song is meant
+FILLER_WORDS = {'play', 'the', 'a', 'an', 'that', 'this', 'song', 'track', 'again', 'please', 'one', 'by', 'me',
+                'official', 'video', 'audio', 'lyrics', 'music'}
+
+
+def tokens(text: str) -> [str]:
+    return re.findall(r"\w+", text.lower())
+
+
+def similarity(query: str, title: str) -> float:
+    """How well a title matches a query, from 0 to 1.
+    Each meaningful query word is matched against its closest title word, which tolerates typos and word order.
+    Titles with fewer words the query didn't ask for score slightly higher."""
+    query_words = set(tokens(query)) - FILLER_WORDS or set(tokens(query))
+    title_words = set(tokens(title))
+    if not query_words or not title_words:
+        return 0.
+    matched = set()
+    total = 0.
+    for word in query_words:
+        if word in title_words:
+            best, closest = 1., word
+        else:
+            best, closest = max((SequenceMatcher(None, word, t).ratio(), t) for t in title_words)
+        total += best
+        if best > .8:
+            matched.add(closest)
+    return .85 * total / len(query_words) + .15 * len(matched) / len(title_words)
+
+
+class SearchIndex:
+    """Caches query -> ranked results for `ttl` seconds, and keeps a word index of recently played titles, so that
+    asking for a song which was played recently resolves without going to youtube at all.
+    Thread safe, since searches run on extraction workers."""
+
+    def __init__(self, ttl: float = 3600, max_queries: int = 1024, max_recent: int = 2000,
+                 local_threshold: float = .85):
+        self.ttl = ttl
+        self.max_queries = max_queries
+        self.max_recent = max_recent
+        self.local_threshold = local_threshold
+
+        self.hits = 0
+        self.local_hits = 0
+        self.misses = 0
+
+        self._queries = OrderedDict()  # normalized query -> (stored at, [(score, url, title)])
+        self._recent = OrderedDict()  # url -> title, least recently played first
+        self._words = {}  # word -> set of urls of recent titles containing it
+        self._lock = threading.Lock()
+
+    def rank(self, query: str, entries: [dict]) -> [(float, str, str)]:
+        """Scores yt_dlp search entries against the query, best first. Youtube's own order breaks ties."""
+        ranked = []
+        for position, entry in enumerate(entries):
+            url = entry.get('webpage_url') or entry.get('url')
+            if entry.get('ie_key') == 'Youtube' and entry.get('id'):
+                url = f"https://www.youtube.com/watch?v={entry['id']}"
+            if not url or not entry.get('title'):
+                continue
+            ranked.append((similarity(query, entry['title']) - position * .001, url, entry['title']))
+        return sorted(ranked, reverse=True)
+
+    def cached(self, query: str) -> Optional[list]:
+        key = ' '.join(tokens(query))
+        with self._lock:
+            stored = self._queries.get(key)
+            if stored is None or time.time() - stored[0] > self.ttl:
+                self.misses += 1
+                return None
+            self._queries.move_to_end(key)
+            self.hits += 1
+            return stored[1]
+
+    def store(self, query: str, results: list) -> None:
+        with self._lock:
+            self._queries[' '.join(tokens(query))] = (time.time(), results)
+            while len(self._queries) > self.max_queries:
+                self._queries.popitem(last=False)
+
+    def remember(self, title: str, url: str) -> None:
+        """Adds a played song to the local index."""
+        with self._lock:
+            if url in self._recent:
+                self._recent.move_to_end(url)
+                return
+            self._recent[url] = title
+            for word in set(tokens(title)):
+                self._words.setdefault(word, set()).add(url)
+            while len(self._recent) > self.max_recent:
+                old_url, old_title = self._recent.popitem(last=False)
+                for word in set(tokens(old_title)):
+                    urls = self._words.get(word)
+                    if urls is not None:
+                        urls.discard(old_url)
+                        if not urls:
+                            del self._words[word]
+
+    def local_match(self, query: str) -> Optional[tuple]:
+        """Returns (url, score) of a recently played title which matches the query well enough, if there is one."""
+        words = set(tokens(query)) - FILLER_WORDS
+        with self._lock:
+            candidates = set().union(*(self._words.get(word, ()) for word in words)) if words else set()
+            scored = [(similarity(query, self._recent[url]), url) for url in candidates]
+        if not scored:
+            return None
+        score, url = max(scored)
+        if score < self.local_threshold:
+            return None
+        self.local_hits += 1
+        return url, score
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'local_hits': self.local_hits, 'misses': self.misses,
+                'queries': len(self._queries), 'recent': len(self._recent)}
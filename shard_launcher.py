@@ -0,0 +1,135 @@
+"""
+Runs the bot as several worker processes, each owning a contiguous range of shards with its own cogs and players.
+The supervisor restarts workers that die, backing off if they keep dying.
+
+Usage: python shard_launcher.py
+"""
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+
+import yaml
+
+BOT_DIR = os.path.realpath(os.path.dirname(__file__))
+
+# A worker that stays up this long is considered healthy again, and its restart backoff is reset
+STABLE_UPTIME = 60
+MAX_BACKOFF = 60
+
+if not os.path.isfile(f"{BOT_DIR}/config.yaml"):
+    sys.exit("'config.yaml' not found!")
+else:
+    with open(f"{BOT_DIR}/config.yaml") as file:
+        config = yaml.load(file, Loader=yaml.FullLoader)
+
+logger = logging.getLogger("ytbot.supervisor")
+logger.setLevel(config.get("log_level") or logging.DEBUG)
+fh = logging.FileHandler(config.get("logfile") or 'ytbot.log')
+fh.setFormatter(logging.Formatter(fmt='%(asctime)s %(levelname)-8s %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+logger.addHandler(fh)
+
+
+def recommended_shard_count() -> int:
+    """Asks discord how many shards it recommends for this bot."""
+    request = urllib.request.Request("https://discord.com/api/v10/gateway/bot",
+                                     headers={"Authorization": f"Bot {config['token']}",
+                                              "User-Agent": "DiscordBot (ytbot, 1.0)"})
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.load(response)["shards"]
+
+
+def shard_ranges(shard_count: int, workers: int) -> [[int]]:
+    """Splits the shards into `workers` contiguous ranges of (nearly) equal size."""
+    workers = max(1, min(workers, shard_count))
+    size, extra = divmod(shard_count, workers)
+    ranges, start = [], 0
+    for i in range(workers):
+        end = start + size + (1 if i < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+
+class Worker:
+    def __init__(self, index: int, shard_ids: [int], shard_count: int):
+        self.index = index
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.process = None
+        self.started_at = 0.
+        self.backoff = 1.
+        self.restart_at = 0.
+
+    def start(self):
+        env = {**os.environ,
+               "YTBOT_WORKER": str(self.index),
+               "YTBOT_SHARD_IDS": ",".join(map(str, self.shard_ids)),
+               "YTBOT_SHARD_COUNT": str(self.shard_count)}
+        self.process = subprocess.Popen([sys.executable, f"{BOT_DIR}/bot.py"], cwd=BOT_DIR, env=env)
+        self.started_at = time.monotonic()
+        logger.info(f"Started worker {self.index} (pid {self.process.pid}) for shards {self.shard_ids}")
+
+    def check(self):
+        """Restarts the worker if it has exited, waiting longer between restarts the more often it dies."""
+        if self.process is None:
+            if time.monotonic() >= self.restart_at:
+                self.start()
+            return
+
+        code = self.process.poll()
+        if code is None:
+            return
+
+        if time.monotonic() - self.started_at > STABLE_UPTIME:
+            self.backoff = 1.
+        logger.warning(f"Worker {self.index} exited with code {code}, restarting in {self.backoff:.0f}s")
+        self.process = None
+        self.restart_at = time.monotonic() + self.backoff
+        self.backoff = min(MAX_BACKOFF, self.backoff * 2)
+
+    def stop(self, timeout=10.):
+        if self.process is None or self.process.poll() is not None:
+            return
+        self.process.terminate()
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+def main():
+    shard_count = config.get("shard_count") or "auto"
+    if shard_count == "auto":
+        shard_count = recommended_shard_count()
+    workers = [Worker(i, shards, shard_count)
+               for i, shards in enumerate(shard_ranges(shard_count, config.get("shard_workers") or os.cpu_count()))]
+    logger.info(f"Launching {len(workers)} worker(s) for {shard_count} shard(s)")
+
+    stopping = False
+
+    def stop(signum, _):
+        nonlocal stopping
+        logger.info(f"Received signal {signum}, stopping workers")
+        stopping = True
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    for worker in workers:
+        worker.start()
+    while not stopping:
+        time.sleep(1)
+        for worker in workers:
+            worker.check()
+
+    for worker in workers:
+        worker.stop()
+
+
+if __name__ == "__main__":
+    main()
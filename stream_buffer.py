@@ -0,0 +1,227 @@
+import errno
+import http.client
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import urllib.request
+import weakref
+
+import metrics
+
+logger = logging.getLogger("ytbot")
+
+STREAM_RECONNECTS = metrics.counter("ytbot_stream_reconnects_total", "Times a buffered stream reconnected mid-song")
+STREAM_UNDERRUNS = metrics.counter("ytbot_stream_buffer_underruns_total",
+                                   "Times ffmpeg had to wait for a buffered stream that wasn't finished")
+STREAM_FAILURES = metrics.counter("ytbot_stream_failures_total", "Buffered streams which gave up before the end")
+
+_buffers = weakref.WeakSet()
+
+
+class RingBuffer:
+    """A bounded byte FIFO between one writer thread and one reader thread. Writes block while it is full, reads
+    block while it is empty, until the writer finishes or either side closes it."""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._data = bytearray(capacity)
+        self._start = 0
+        self._size = 0
+        self._finished = False  # The writer has nothing more to add
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def finished(self) -> bool:
+        return self._finished
+
+    def write(self, data) -> bool:
+        """Appends all of `data`. Returns False if the buffer was closed before it fit."""
+        view = memoryview(data)
+        while view:
+            with self._cond:
+                while self._size == self.capacity and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return False
+                end = (self._start + self._size) % self.capacity
+                count = min(len(view), self.capacity - self._size, self.capacity - end)
+                self._data[end:end + count] = view[:count]
+                self._size += count
+                self._cond.notify_all()
+            view = view[count:]
+        return True
+
+    def read(self, limit: int, on_wait=None) -> bytes:
+        """Takes up to `limit` bytes. Returns b'' once the writer has finished and everything has been read,
+        or when the buffer is closed. `on_wait` is called if the read has to wait for the writer."""
+        with self._cond:
+            if self._size == 0 and not self._finished and not self._closed and on_wait is not None:
+                on_wait()
+            while self._size == 0 and not self._finished and not self._closed:
+                self._cond.wait()
+            if self._closed or self._size == 0:
+                return b''
+            count = min(limit, self._size, self.capacity - self._start)
+            chunk = bytes(self._data[self._start:self._start + count])
+            self._start = (self._start + count) % self.capacity
+            self._size -= count
+            self._cond.notify_all()
+            return chunk
+
+    def finish(self):
+        with self._cond:
+            self._finished = True
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class StreamBuffer:
+    """Reads an http stream ahead of playback into a RingBuffer, and feeds it to ffmpeg through a named pipe.
+
+    The stream is fetched in ranged requests, so a dropped connection is resumed from the byte it stopped at instead
+    of killing the song, and ffmpeg keeps playing from what is buffered while it reconnects. ffmpeg reads the pipe
+    like any other file, and sees a normal end of file once the whole stream has been passed on.
+    """
+
+    def __init__(self, url: str, headers: dict = None, capacity: int = 8 * 1024 ** 2,
+                 request_size: int = 10 * 1024 ** 2, max_retries: int = 5, timeout: float = 10.):
+        self.url = url
+        self.headers = dict(headers or {})
+        self.request_size = request_size  # Youtube throttles requests for more than ~10MB at a time
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.received = 0
+        self.total = None
+
+        self._ring = RingBuffer(capacity)
+        self._closed = threading.Event()
+        self._dir = tempfile.mkdtemp(prefix="ytbot-stream-")
+        self.path = os.path.join(self._dir, "audio")
+        os.mkfifo(self.path)
+        _buffers.add(self)
+
+    @property
+    def fill(self) -> float:
+        """How full the read-ahead buffer is, from 0 to 1."""
+        return len(self._ring) / self._ring.capacity
+
+    def start(self):
+        threading.Thread(target=self.__fetch, name="stream-fetch", daemon=True).start()
+        threading.Thread(target=self.__feed, name="stream-feed", daemon=True).start()
+        return self
+
+    def close(self):
+        """Stops both threads and removes the pipe. Safe to call more than once."""
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self._ring.close()
+        _buffers.discard(self)
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+    def __fetch(self):
+        failures = 0
+        try:
+            while not self._closed.is_set() and (self.total is None or self.received < self.total):
+                try:
+                    if not self.__fetch_range():
+                        break  # The server sent everything it had
+                    failures = 0
+                except (OSError, http.client.HTTPException) as e:
+                    failures += 1
+                    if failures > self.max_retries:
+                        STREAM_FAILURES.inc()
+                        logger.warning(f"Giving up on stream after {self.received} bytes: {e}")
+                        break
+                    STREAM_RECONNECTS.inc()
+                    logger.debug(f"Stream dropped at byte {self.received} ({e}), reconnecting")
+                    self._closed.wait(min(.25 * 2 ** failures, 4.))
+        finally:
+            self._ring.finish()
+
+    def __fetch_range(self) -> bool:
+        """Fetches the next range into the ring buffer. Returns False if the server had no more to send."""
+        end = self.received + self.request_size - 1
+        if self.total is not None:
+            end = min(end, self.total - 1)
+        request = urllib.request.Request(self.url, headers={**self.headers, 'Range': f"bytes={self.received}-{end}"})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            skip = 0
+            if response.status == 206:
+                match = re.match(r"bytes (\d+)-\d+/(\d+)", response.headers.get('Content-Range') or '')
+                if match:
+                    self.total = int(match.group(2))
+            else:
+                # Range was ignored, so the body starts from the beginning again
+                self.total = int(response.headers['Content-Length']) if response.headers.get('Content-Length') else None
+                skip = self.received
+            fetched = 0
+            while not self._closed.is_set():
+                chunk = response.read(64 * 1024)
+                if not chunk:
+                    break
+                if skip:
+                    dropped = min(skip, len(chunk))
+                    chunk, skip = chunk[dropped:], skip - dropped
+                if chunk and not self._ring.write(chunk):
+                    return False
+                self.received += len(chunk)
+                fetched += len(chunk)
+            if response.status != 206:
+                # Read to the end of the whole stream
+                if self.total is None:
+                    self.total = self.received
+                return False
+            if fetched and self.received <= end and not self._closed.is_set():
+                # The connection closed early without an error, the next range picks up where it stopped
+                STREAM_RECONNECTS.inc()
+            return fetched > 0
+
+    def __feed(self):
+        fd = None
+        try:
+            # Opening a pipe for writing blocks until ffmpeg opens it, so poll instead in case ffmpeg never does
+            while fd is None and not self._closed.is_set():
+                try:
+                    fd = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+                except OSError as e:
+                    if e.errno not in (errno.ENXIO, errno.ENOENT):
+                        raise
+                    if e.errno == errno.ENOENT or self._closed.wait(.02):
+                        return
+            if fd is None:
+                return
+            os.set_blocking(fd, True)
+            while True:
+                chunk = self._ring.read(64 * 1024, on_wait=STREAM_UNDERRUNS.inc)
+                if not chunk:
+                    break
+                os.write(fd, chunk)
+        except OSError:
+            pass  # ffmpeg went away, the source is being cleaned up
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+
+def _fill_ratio():
+    buffers = list(_buffers)
+    return min(b.fill for b in buffers) if buffers else None
+
+
+metrics.gauge("ytbot_stream_buffers", "Buffered streams which are playing").set_function(lambda: len(_buffers))
+metrics.gauge("ytbot_stream_buffer_bytes", "Bytes read ahead across all buffered streams").set_function(
+    lambda: sum(len(b._ring) for b in list(_buffers)))
+metrics.gauge("ytbot_stream_buffer_min_fill_ratio",
+              "Fill level of the emptiest read-ahead buffer, the one nearest to running dry").set_function(_fill_ratio)
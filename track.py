@@ -0,0 +1,45 @@
+from typing import Optional
+
+from metadata_cache import cache_key
+
+
+class Track:
+    """A queued song, as little as is needed to show it and to find it again.
+
+    Everything else, like the stream url and formats, is only fetched from yt_dlp (or the metadata cache) once the song
+    comes up. Youtube videos only keep their id, the url is rebuilt from it.
+    """
+    __slots__ = ('video_id', 'title', 'duration', 'requester_id', 'page_url', 'broadcast', 'start_at')
+
+    def __init__(self, url: str, title: str, duration: Optional[float], requester_id: int, *, broadcast=False,
+                 start_at=0.):
+        key = cache_key(url)
+        # Only the id is kept when the url can be rebuilt from it
+        self.video_id = key if key != url.strip() else None
+        self.page_url = None if self.video_id else url
+        self.title = title
+        self.duration = duration
+        self.requester_id = requester_id
+        self.broadcast = broadcast  # Played as a listener of a shared broadcast
+        self.start_at = start_at  # Seconds into the song to start from, set on a song that was cut off by a restart
+
+    @classmethod
+    def from_info(cls, data: dict, requester_id: int, **kwargs) -> 'Track':
+        return cls(data['webpage_url'], data.get('title') or data['webpage_url'], data.get('duration'), requester_id,
+                   **kwargs)
+
+    @property
+    def webpage_url(self) -> str:
+        return self.page_url or f"https://www.youtube.com/watch?v={self.video_id}"
+
+    @property
+    def key(self) -> str:
+        """Key of the song in the metadata cache."""
+        return self.video_id or cache_key(self.page_url)
+
+    def __getitem__(self, item: str):
+        """Allows us to access attributes similar to a dict."""
+        return self.__getattribute__(item)
+
+    def __repr__(self):
+        return f"Track({self.webpage_url!r}, {self.title!r})"
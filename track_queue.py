@@ -0,0 +1,204 @@
+import asyncio
+import itertools
+from collections import deque
+from typing import Optional
+
+
+class QueueEmpty(Exception):
+    pass
+
+
+class _Node:
+    __slots__ = ('entry_id', 'item', 'video_id', 'prev', 'next')
+
+    def __init__(self, entry_id, item, video_id):
+        self.entry_id = entry_id
+        self.item = item
+        self.video_id = video_id
+        self.prev = None
+        self.next = None
+
+
+class TrackQueue:
+    """Playlist with constant time append, push-front, remove, move and dedupe.
+
+    Entries sit in a doubly linked list, with a dict from entry id to node so any entry can be unlinked or relinked
+    without a scan, and a count of entries per video id for dedupe. Every entry gets an id when it's added, which
+    stays valid until it leaves the queue. get() can be awaited just like asyncio.Queue.get(), or `on_put` is called
+    whenever an item is added.
+    Not thread safe, only use it from the event loop.
+    """
+
+    def __init__(self, key=lambda item: None, on_put=None):
+        self._key = key  # Video id of an item
+        self._on_put = on_put
+        self._head = _Node(None, None, None)  # Sentinel, head.next is the first entry and head.prev the last
+        self._head.prev = self._head.next = self._head
+        self._nodes = {}
+        self._videos = {}  # video id -> number of entries queued for it
+        self._ids = itertools.count(1)
+        self._getters = deque()
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __contains__(self, entry_id):
+        return entry_id in self._nodes
+
+    def qsize(self) -> int:
+        return len(self._nodes)
+
+    def empty(self) -> bool:
+        return not self._nodes
+
+    def has_video(self, video_id) -> bool:
+        return video_id in self._videos
+
+    def put_nowait(self, item, *, dedupe=False) -> Optional[int]:
+        """Appends an item and returns its entry id. With `dedupe`, items whose video is already queued are dropped
+        and None is returned."""
+        return self.__add(item, self._head.prev, dedupe)
+
+    async def put(self, item, *, dedupe=False) -> Optional[int]:
+        return self.put_nowait(item, dedupe=dedupe)
+
+    def push_front(self, item, *, dedupe=False) -> Optional[int]:
+        return self.__add(item, self._head, dedupe)
+
+    def get_nowait(self):
+        if not self._nodes:
+            raise QueueEmpty()
+        return self.__unlink(self._head.next).item
+
+    async def get(self):
+        while not self._nodes:
+            waiter = asyncio.get_running_loop().create_future()
+            self._getters.append(waiter)
+            try:
+                await waiter
+            except BaseException:
+                waiter.cancel()
+                try:
+                    self._getters.remove(waiter)
+                except ValueError:
+                    pass
+                # Pass the wakeup on if this getter was woken up but won't take the item
+                if self._nodes:
+                    self.__wakeup_getter()
+                raise
+        return self.get_nowait()
+
+    def remove(self, entry_id: int):
+        """Removes an entry by id and returns its item. Raises KeyError if it isn't queued."""
+        return self.__unlink(self._nodes[entry_id]).item
+
+    def move(self, entry_id: int, *, before: int = None) -> None:
+        """Moves an entry in front of the entry `before`, or to the end of the queue if `before` is None."""
+        node = self._nodes[entry_id]
+        anchor = self._head if before is None else self._nodes[before]
+        if anchor is node:
+            return
+        self.__detach(node)
+        self.__attach(node, anchor.prev)
+
+    def move_to_front(self, entry_id: int) -> None:
+        node = self._nodes[entry_id]
+        self.__detach(node)
+        self.__attach(node, self._head)
+
+    def dedupe(self) -> int:
+        """Removes every entry whose video is already queued earlier on. Returns how many were removed."""
+        seen = set()
+        removed = 0
+        node = self._head.next
+        while node is not self._head:
+            following = node.next
+            if node.video_id is not None:
+                if node.video_id in seen:
+                    self.__unlink(node)
+                    removed += 1
+                else:
+                    seen.add(node.video_id)
+            node = following
+        return removed
+
+    def clear(self) -> None:
+        self._head.prev = self._head.next = self._head
+        self._nodes.clear()
+        self._videos.clear()
+
+    def peek(self, count: int) -> list:
+        """The first `count` items, without removing them."""
+        return [item for _, item in self.page(0, count)]
+
+    def page(self, offset: int = 0, limit: int = 10, *, after: int = None) -> [(int, object)]:
+        """Returns up to `limit` (entry id, item) pairs, starting `offset` entries in, or right after entry `after`.
+        Walking from an entry id costs O(limit). An offset is walked from whichever end of the queue is nearer."""
+        if after is not None:
+            node = self._nodes[after].next
+        elif offset >= len(self._nodes):
+            return []
+        elif offset <= len(self._nodes) // 2:
+            node = self._head.next
+            for _ in range(offset):
+                node = node.next
+        else:
+            node = self._head
+            for _ in range(len(self._nodes) - offset):
+                node = node.prev
+
+        entries = []
+        while node is not self._head and len(entries) < limit:
+            entries.append((node.entry_id, node.item))
+            node = node.next
+        return entries
+
+    def __iter__(self):
+        node = self._head.next
+        while node is not self._head:
+            yield node.item
+            node = node.next
+
+    def __add(self, item, after, dedupe):
+        video_id = self._key(item)
+        if dedupe and video_id is not None and video_id in self._videos:
+            return None
+        node = _Node(next(self._ids), item, video_id)
+        self._nodes[node.entry_id] = node
+        if video_id is not None:
+            self._videos[video_id] = self._videos.get(video_id, 0) + 1
+        self.__attach(node, after)
+        self.__wakeup_getter()
+        if self._on_put is not None:
+            self._on_put()
+        return node.entry_id
+
+    def __unlink(self, node):
+        self.__detach(node)
+        del self._nodes[node.entry_id]
+        if node.video_id is not None:
+            remaining = self._videos[node.video_id] - 1
+            if remaining:
+                self._videos[node.video_id] = remaining
+            else:
+                del self._videos[node.video_id]
+        return node
+
+    @staticmethod
+    def __detach(node):
+        node.prev.next = node.next
+        node.next.prev = node.prev
+
+    @staticmethod
+    def __attach(node, after):
+        node.prev = after
+        node.next = after.next
+        after.next.prev = node
+        after.next = node
+
+    def __wakeup_getter(self):
+        while self._getters:
+            waiter = self._getters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
@@ -1,17 +1,37 @@
 import asyncio
-import itertools
+import re
+
+import retry
 
 
 MAX_WAIT = 8
 
 
 async def async_retry_backoff(retries, async_func):
+    """Retries `async_func` on any exception, up to `retries` more times, with jittered exponential backoff."""
     if retries < 0:
         raise AttributeError(f"retries cannot be negative number")
-    for i in itertools.count(start=0):
-        try:
-            return await async_func()
-        except Exception as err:
-            if i >= retries:
-                raise TimeoutError(f"Attempted func {retries + 1} time(s), but failed: '{type(err)} {{ {str(err)} }}'")
-            await asyncio.sleep(min(MAX_WAIT, 2 ^ i))
+    try:
+        return await retry.retry(async_func, name=getattr(async_func, '__name__', 'call'), attempts=retries + 1,
+                                 retryable=lambda err: True, base=1., cap=MAX_WAIT)
+    except asyncio.CancelledError:
+        raise
+    except Exception as err:
+        raise TimeoutError(f"Attempted func {retries + 1} time(s), but failed: '{type(err)} {{ {str(err)} }}'")
+
+
+def parse_timestamp(text: str) -> float:
+    """Seconds in a timestamp like `90`, `1:30` or `1:02:03`. Raises ValueError if it isn't one."""
+    parts = text.strip().split(':')
+    if not 1 <= len(parts) <= 3 or not all(re.fullmatch(r"\d+(\.\d+)?", part) for part in parts):
+        raise ValueError(f"not a timestamp: '{text}'")
+    seconds = 0.
+    for part in parts:
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+def format_timestamp(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
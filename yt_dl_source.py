@@ -1,10 +1,120 @@
 import discord
 import asyncio
-import yt_dlp
+import itertools
+import os
+import threading
+import time
 from functools import partial
 
+import metrics
+
+from audio_cache import AudioCache
+from broadcast import FRAME_SECONDS, BroadcastHub
+from extraction_scheduler import ExtractionScheduler, Priority
+from loudness import LoudnessNormalizer
+from metadata_cache import MetadataCache, cache_key
+from retry import CircuitBreaker, RetryBudget, retry
+from stream_buffer import StreamBuffer
+from track import Track
+
+
+DEFAULT_VOLUME = .5
+
+EXTRACTION_SECONDS = metrics.histogram("ytbot_extraction_seconds", "Time spent in yt_dlp", ("kind",))
+EXTRACTION_FAILURES = metrics.counter("ytbot_extraction_failures_total", "yt_dlp calls which raised", ("kind",))
+# Broadcasts run for hours, so let ffmpeg ride out dropped connections itself
+BROADCAST_BEFORE_OPTIONS = "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5"
+# How long the broadcast thread waits for a stream url when a live stream is reopened
+REOPEN_TIMEOUT = 60
+
+EXTRACTIONS_COALESCED = metrics.counter("ytbot_extractions_coalesced_total",
+                                        "Extractions which waited on one already in flight for the same video",
+                                        ("kind",))
+FFMPEG_SPAWN_SECONDS = metrics.histogram("ytbot_ffmpeg_spawn_seconds", "Time to start ffmpeg for a song", ("mode",))
+
+
+def instrumented(kind: str, func):
+    """Wraps a blocking yt_dlp call so that its duration and failures are recorded."""
+    def run():
+        try:
+            with EXTRACTION_SECONDS.time(kind=kind):
+                return func()
+        except Exception:
+            EXTRACTION_FAILURES.inc(kind=kind)
+            raise
+    return run
+
+
+class _Flight:
+    """An extraction in progress, shared by every caller that asked for the same video meanwhile."""
+    __slots__ = ('task', 'need_stream', 'priority', 'waiters')
+
+    def __init__(self, task, need_stream, priority):
+        self.task = task
+        self.need_stream = need_stream
+        self.priority = priority
+        self.waiters = 0
+
+
+class OpusSource(discord.FFmpegOpusAudio):
+    """Plays a stream's Opus packets without decoding them to PCM in between.
+
+    When the input is already Opus and the volume is 1.0, ffmpeg just copies the packets through. Otherwise ffmpeg
+    applies the volume in its own filter chain and encodes to Opus itself, so neither Python nor libopus in this
+    process ever touches the audio. The volume is fixed once the source has been created.
+    """
+    buffer = None  # StreamBuffer feeding ffmpeg, if the stream is buffered
+    start_at = 0  # Seconds into the song that ffmpeg started from
+    frames = 0  # Frames read by the voice client so far
+
+    def __init__(self, source, *, data, requester, volume=DEFAULT_VOLUME, gain=1., before_options=None):
+        self.requester = requester
+
+        self.title = data.get('title')
+        self.web_url = data.get('webpage_url')
+        self.duration = data.get('duration')
+        self.gain = gain
+        self._volume = volume
+
+        if abs(volume * gain - 1.) < 1e-3 and data.get('acodec') == 'opus':
+            super().__init__(source, codec='opus', before_options=before_options)
+        else:
+            super().__init__(source, bitrate=128, before_options=before_options,
+                             options=f"-filter:a volume={volume * gain:.3f}")
+
+    def __getitem__(self, item: str):
+        return self.__getattribute__(item)
+
+    def read(self) -> bytes:
+        packet = super().read()
+        if packet:
+            self.frames += 1
+        return packet
+
+    @property
+    def position(self) -> float:
+        """Seconds into the song of the last frame played."""
+        return self.start_at + self.frames * FRAME_SECONDS
+
+    @property
+    def volume(self):
+        return self._volume
+
+    @volume.setter
+    def volume(self, value):
+        # The ffmpeg process is already running with the old volume, so this only applies to the next song
+        self._volume = value
+
+    def cleanup(self):
+        super().cleanup()
+        if self.buffer is not None:
+            self.buffer.close()
+
 
 class YTDLSource(discord.PCMVolumeTransformer):
+    playback_mode = "pcm"
+    # Volume of a player when config.yaml doesn't set one
+    default_volume = DEFAULT_VOLUME
     ytdl_opts = {
         "format": "bestaudio/best",
         "postprocessors": [{
@@ -14,9 +124,27 @@ class YTDLSource(discord.PCMVolumeTransformer):
         }],
         'source_address': '0.0.0.0'
     }
-    ytdl = yt_dlp.YoutubeDL(ytdl_opts)
+    ytdl = None  # Built on first use by get_ytdl(), since importing yt_dlp takes a while
+    _ytdl_lock = threading.Lock()
+    cache = MetadataCache()
+    scheduler = ExtractionScheduler()
+    _inflight = {}  # video id -> _Flight
+    # Shared by every yt_dlp call in the process, so throttling seen by one guild protects all of them
+    breaker = CircuitBreaker("youtube")
+    retry_budget = RetryBudget()
+    extraction_attempts = 3
+    audio_cache = None
+    loudness = None
+    buffer_size = 0  # Bytes of read-ahead for streamed songs, 0 streams straight from youtube
+    buffer = None
+    broadcasts = BroadcastHub()
+    broadcast = False  # Whether this is a listener of a shared broadcast
+    start_at = 0  # Seconds into the song that ffmpeg started from
+    frames = 0  # Frames read by the voice client so far
 
-    def __init__(self, source, *, data, requester):
+    def __init__(self, source, *, data, requester, gain=1.):
+        # Loudness normalization gain, applied on top of whatever volume gets set
+        self.gain = gain
         super().__init__(source)
         self.requester = requester
 
@@ -33,36 +161,314 @@ class YTDLSource(discord.PCMVolumeTransformer):
         """
         return self.__getattribute__(item)
 
+    def read(self) -> bytes:
+        data = super().read()
+        if data:
+            self.frames += 1
+        return data
+
+    @property
+    def position(self) -> float:
+        """Seconds into the song of the last frame played."""
+        return self.start_at + self.frames * FRAME_SECONDS
+
+    @property
+    def volume(self):
+        return self._user_volume
+
+    @volume.setter
+    def volume(self, value):
+        self._user_volume = value
+        discord.PCMVolumeTransformer.volume.fset(self, value * self.gain)
+
+    def cleanup(self):
+        super().cleanup()
+        if self.buffer is not None:
+            self.buffer.close()
+
     @classmethod
-    async def create_source(cls, ctx, search: str, *, loop, download=False):
-        loop = loop or asyncio.get_event_loop()
+    def configure(cls, config):
+        """Applies the optional settings from config.yaml"""
+        cls.cache = MetadataCache(max_entries=config.get("metadata_cache_size") or 512,
+                                  ttl=config.get("metadata_cache_ttl") or 6 * 3600,
+                                  path=config.get("metadata_cache_dir"))
+        if config.get("playback_mode") == "opus":
+            # Ask youtube for its native Opus/WebM formats, so the packets can be passed straight through
+            cls.playback_mode = "opus"
+            # Packets are only passed through untouched at full volume
+            cls.default_volume = 1.
+            cls.ytdl_opts = {**cls.ytdl_opts,
+                             "format": "bestaudio[acodec=opus]/bestaudio/best",
+                             "postprocessors": [{"key": "FFmpegExtractAudio", "preferredcodec": "opus"}]}
+            cls.ytdl = None
+        cls.scheduler.shutdown()
+        cls.scheduler = ExtractionScheduler(workers=config.get("extraction_workers") or 4)
+        cls.extraction_attempts = config.get("extraction_attempts") or 3
+        cls.breaker = CircuitBreaker("youtube", failure_threshold=config.get("circuit_failure_threshold") or 5,
+                                     reset_timeout=config.get("circuit_reset_timeout") or 30.)
+        cls.audio_cache = AudioCache(config.get("audio_cache_dir") or "cache/audio",
+                                     max_bytes=config.get("audio_cache_max_bytes") or 2 * 1024 ** 3)
+        if config.get("loudness_normalization"):
+            cls.loudness = LoudnessNormalizer(config.get("loudness_cache") or "cache/loudness.json",
+                                              target=config.get("loudness_target") or -14.,
+                                              analyse_seconds=config.get("loudness_analysis_seconds", 180))
+        cls.broadcasts = BroadcastHub(linger=config.get("broadcast_linger") or 10.)
+        if config.get("stream_buffer") and hasattr(os, "mkfifo"):
+            cls.buffer_size = config.get("stream_buffer_size") or 8 * 1024 ** 2
 
-        to_run = partial(YTDLSource.ytdl.extract_info, url=search, download=download)
-        data = await loop.run_in_executor(None, to_run)
+    @classmethod
+    def get_ytdl(cls):
+        """The shared YoutubeDL instance. yt_dlp is only imported, and the instance built, the first time this is
+        called, so it stays off the startup path. Safe to call from extraction workers."""
+        if cls.ytdl is None:
+            with cls._ytdl_lock:
+                if cls.ytdl is None:
+                    import yt_dlp
+                    cls.ytdl = yt_dlp.YoutubeDL(cls.ytdl_opts)
+        return cls.ytdl
 
+    @classmethod
+    def from_source(cls, source: str, *, data, requester, volume=DEFAULT_VOLUME, start_at=0):
+        """Builds a playable source for a local file or stream url, in the configured playback mode, starting
+        `start_at` seconds in.
+        If loudness normalization is on, the track's cached gain is applied, or an analysis is started for it."""
+        gain = 1.
+        if cls.loudness is not None:
+            gain = cls.loudness.gain(data.get('id'))
+            if gain is None:
+                cls.loudness.schedule(data.get('id'), source, data.get('http_headers'))
+                gain = 1.
+
+        buffer = None
+        if cls.buffer_size and not start_at and source.startswith(("http://", "https://")):
+            # ffmpeg reads from a read-ahead buffer which rides out stalls and reconnects. Not when seeking, since
+            # ffmpeg can't seek in a pipe and would have to read everything up to `start_at` through it.
+            buffer = StreamBuffer(source, data.get('http_headers'), capacity=cls.buffer_size).start()
+            source = buffer.path
+
+        # Seeking on the input side means ffmpeg doesn't decode the part that is skipped
+        before_options = f"-ss {start_at}" if start_at else None
+        start = time.perf_counter()
+        try:
+            if cls.playback_mode == "opus":
+                player = OpusSource(source, data=data, requester=requester, volume=volume, gain=gain,
+                                    before_options=before_options)
+            else:
+                player = cls(discord.FFmpegPCMAudio(source, before_options=before_options), data=data,
+                             requester=requester, gain=gain)
+                player.volume = volume
+        except Exception:
+            if buffer is not None:
+                buffer.close()
+            raise
+        player.buffer = buffer
+        player.start_at = start_at
+        FFMPEG_SPAWN_SECONDS.observe(time.perf_counter() - start, mode=cls.playback_mode)
+        return player
+
+    @classmethod
+    async def extract_info(cls, url: str, *, loop, need_stream=False, valid_until=None, guild_id=None,
+                           priority=Priority.PLAYBACK) -> dict:
+        """Returns the info dict for a url, going to yt_dlp only when the cache can't answer.
+        If `need_stream` is set, the returned dict is guaranteed to contain a stream url which is still valid
+        at `valid_until` (defaults to now).
+        Extraction runs on the extraction scheduler, queued fairly per guild at the given priority. Concurrent calls
+        for the same video share one extraction, as long as it fetches at least as much and runs at least as soon."""
+        key = cache_key(url)
+        data = cls.cache.get(key, need_stream=need_stream, valid_until=valid_until)
+        if data is not None:
+            return data
+
+        flight = cls._inflight.get(key)
+        if flight is not None and (flight.need_stream or not need_stream) and flight.priority <= priority:
+            EXTRACTIONS_COALESCED.inc(kind="stream" if need_stream else "metadata")
+        else:
+            to_run = partial(cls.__extract_blocking, url, need_stream=need_stream)
+            task = asyncio.ensure_future(cls.run_extraction(to_run, guild_id=guild_id, priority=priority))
+            flight = _Flight(task, need_stream, priority)
+            cls._inflight[key] = flight
+            task.add_done_callback(lambda _: cls.__land(key, flight))
+        return dict(await cls.__wait(key, flight))
+
+    @classmethod
+    async def run_extraction(cls, func, *, guild_id=None, priority=Priority.PLAYBACK):
+        """Runs a blocking yt_dlp call on the extraction scheduler, behind the youtube circuit breaker.
+        Errors that may go away, like throttling or a dropped connection, are retried with jittered backoff while the
+        retry budget allows. Only use this for calls which are safe to repeat."""
+        return await retry(lambda: cls.scheduler.run(func, guild_id=guild_id, priority=priority), name="extraction",
+                           attempts=cls.extraction_attempts, budget=cls.retry_budget, breaker=cls.breaker)
+
+    @classmethod
+    async def __wait(cls, key, flight):
+        # Shielded, so one caller being cancelled doesn't cancel the extraction for everyone else
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                # Every caller gave up, drop the job if it hasn't started yet
+                cls.__land(key, flight)
+                flight.task.cancel()
+
+    @classmethod
+    def __land(cls, key, flight):
+        if cls._inflight.get(key) is flight:
+            del cls._inflight[key]
+
+    @classmethod
+    def __extract_blocking(cls, url, *, need_stream):
+        key = cache_key(url)
+        if not need_stream:
+            data = cls.cache.load(key)
+            if data is not None:
+                return data
+
+        data = instrumented("stream" if need_stream else "metadata",
+                            partial(cls.get_ytdl().extract_info, url=url, download=False))()
         if 'entries' in data:
             # take first item from a playlist
             data = data['entries'][0]
 
-        embed = discord.Embed(title="", description=f"Queued [{data['title']}]({data['webpage_url']}) [{ctx.author.mention}]", color=discord.Color.green())
-        await ctx.send(embed=embed)
+        cls.cache.put(key, data)
+        if data.get('webpage_url') and cache_key(data['webpage_url']) != key:
+            cls.cache.put(cache_key(data['webpage_url']), data)
+        return data
+
+    @classmethod
+    async def resolve_ahead(cls, url: str, *, loop, play_at: float, guild_id=None) -> bool:
+        """Makes sure the cache holds a stream url for `url` that will still be valid at `play_at`.
+        Returns True if the url had to be (re-)resolved, False if the cached one was good enough."""
+        if cls.audio_cache is not None and cache_key(url) in cls.audio_cache:
+            return False  # Plays from disk
+        if cls.cache.stream_expires_at(cache_key(url)) - cls.cache.stream_margin >= play_at:
+            return False
+        await cls.extract_info(url, loop=loop, need_stream=True, valid_until=play_at, guild_id=guild_id,
+                               priority=Priority.PREFETCH)
+        return True
+
+    @classmethod
+    async def open_playlist(cls, url: str, *, requester_id, guild_id=None, page_size=50):
+        """Opens a playlist without resolving any of its entries.
+        Returns the playlist title and an async generator which yields its entries page by page, as Tracks.
+        Only the first page is fetched at playback priority."""
+        to_run = lambda: cls.get_ytdl().extract_info(url=url, download=False, process=False)
+        playlist = await cls.run_extraction(instrumented("playlist", to_run), guild_id=guild_id)
+
+        if 'entries' not in playlist:
+            # Not a playlist after all, just a single song
+            entries = iter([playlist])
+        else:
+            # Flat entries, which yt_dlp only fetches from youtube as the generator is advanced
+            entries = iter(playlist['entries'])
+
+        async def pages():
+            priority = Priority.PLAYBACK
+            while True:
+                to_run = partial(lambda it, n: list(itertools.islice(it, n)), entries, page_size)
+                page = await cls.scheduler.run(instrumented("playlist_page", to_run), guild_id=guild_id,
+                                               priority=priority)
+                if not page:
+                    return
+                yield [cls.__playlist_entry(e, requester_id) for e in page]
+                priority = Priority.BACKGROUND
+
+        return playlist.get('title'), pages()
+
+    @staticmethod
+    def __playlist_entry(entry, requester_id):
+        url = entry.get('webpage_url') or entry.get('url')
+        if entry.get('ie_key') == 'Youtube' and entry.get('id'):
+            url = f"https://www.youtube.com/watch?v={entry['id']}"
+        return Track(url, entry.get('title') or url, entry.get('duration'), requester_id)
+
+    @classmethod
+    async def create_source(cls, ctx, search: str, *, loop, download=False) -> Track:
+        """Looks a song up and returns it as a Track to queue. Nothing is played or streamed yet, and nothing is sent
+        to the channel. With `download`, the song is also downloaded into the audio cache, and will play from disk."""
+        loop = loop or asyncio.get_event_loop()
 
         if download:
-            source = YTDLSource.ytdl.prepare_filename(data)
+            # A cached download plays straight from disk without going anywhere near yt_dlp
+            cached = cls.audio_cache.lookup(cache_key(search))
+            if cached is None:
+                to_run = lambda: cls.audio_cache.download(type(cls.get_ytdl()), cls.ytdl_opts, search)
+                cached = await cls.run_extraction(instrumented("download", to_run), guild_id=ctx.guild.id)
+                cls.cache.put(cache_key(cached[1]['webpage_url']), cached[1])
+            data = cached[1]
         else:
-            return {'webpage_url': data['webpage_url'], 'requester': ctx.author, 'title': data['title']}
+            data = await cls.extract_info(search, loop=loop, guild_id=ctx.guild.id)
 
-        return cls(discord.FFmpegPCMAudio(source), data=data, requester=ctx.author)
+        # Live streams are shared by every guild listening to them
+        return Track.from_info(data, ctx.author.id, broadcast=bool(data.get('is_live')) and not download)
 
     @classmethod
-    async def regather_stream(cls, data, *, loop):
+    async def regather_stream(cls, track: Track, *, loop, requester, guild_id=None, volume=DEFAULT_VOLUME,
+                              start_at=0):
         """Used for preparing a stream, instead of downloading.
-        Since Youtube Streaming links expire."""
+        Since Youtube Streaming links expire. A downloaded file, or a stream url which is still valid, is reused
+        without going to yt_dlp, so this is also how a song is restarted part way through."""
         loop = loop or asyncio.get_event_loop()
-        requester = data['requester']
 
-        to_run = partial(YTDLSource.ytdl.extract_info, url=data['webpage_url'], download=False)
-        data = await loop.run_in_executor(None, to_run)
+        # Songs which have been downloaded before don't need a stream at all
+        cached = cls.audio_cache.lookup(track.key) if cls.audio_cache else None
+        if cached is not None:
+            source, data = cached
+            return cls.from_source(source, data=data, requester=requester, volume=volume, start_at=start_at)
+
+        data = await cls.extract_info(track.webpage_url, loop=loop, need_stream=True, guild_id=guild_id)
+
+        return cls.from_source(data['url'], data=data, requester=requester, volume=volume, start_at=start_at)
+
+    @classmethod
+    async def join_broadcast(cls, track: Track, *, loop, requester, guild_id=None, volume=DEFAULT_VOLUME):
+        """Listens in on the shared broadcast of a stream, starting it if no guild is playing it yet.
+        Every listener gets the same decoded frames, with its own volume on top."""
+        url = track.webpage_url
+        info = await cls.extract_info(url, loop=loop, need_stream=True, guild_id=guild_id)
+        key = cache_key(url)
+
+        def open_source():
+            # Called from the broadcast's thread, again whenever a live stream has to be reopened. Handed to the loop,
+            # so a reopen goes through the extraction scheduler, single flight and the circuit breaker like any other
+            fresh = asyncio.run_coroutine_threadsafe(
+                cls.extract_info(url, loop=loop, need_stream=True, guild_id=guild_id), loop).result(REOPEN_TIMEOUT)
+            return discord.FFmpegPCMAudio(fresh['url'], before_options=BROADCAST_BEFORE_OPTIONS)
+
+        subscriber = cls.broadcasts.subscribe(key, open_source, live=bool(info.get('is_live')))
+        player = cls(subscriber, data=info, requester=requester)
+        player.broadcast = True
+        player.volume = volume
+        return player
+
+
+def _cache_lookups():
+    stats = YTDLSource.cache.stats()
+    return {("metadata", "hit"): stats['hits'], ("metadata", "miss"): stats['misses'],
+            ("stream", "hit"): stats['stream_hits'], ("stream", "miss"): stats['stream_misses'],
+            ("disk", "hit"): stats['disk_hits']}
+
+
+def _audio_cache_lookups():
+    if YTDLSource.audio_cache is None:
+        return {}
+    stats = YTDLSource.audio_cache.stats()
+    return {("hit",): stats['hits'], ("miss",): stats['misses']}
 
-        return cls(discord.FFmpegPCMAudio(data['url']), data=data, requester=requester)
 
+metrics.counter("ytbot_metadata_cache_lookups_total", "Metadata cache lookups",
+                ("kind", "result")).set_function(_cache_lookups)
+metrics.gauge("ytbot_metadata_cache_entries", "Info dicts held in memory").set_function(
+    lambda: YTDLSource.cache.stats()['size'])
+metrics.counter("ytbot_audio_cache_lookups_total", "Audio cache lookups", ("result",)).set_function(
+    _audio_cache_lookups)
+metrics.gauge("ytbot_audio_cache_bytes", "Bytes of audio on disk").set_function(
+    lambda: YTDLSource.audio_cache.size if YTDLSource.audio_cache else 0)
+metrics.gauge("ytbot_extraction_queue_depth", "Extractions waiting for a worker", ("priority",)).set_function(
+    lambda: {(p.name.lower(),): YTDLSource.scheduler.depth(p) for p in Priority})
+metrics.gauge("ytbot_broadcasts", "Streams being broadcast").set_function(
+    lambda: YTDLSource.broadcasts.stats()['broadcasts'])
+metrics.gauge("ytbot_broadcast_listeners", "Voice clients listening to a broadcast").set_function(
+    lambda: YTDLSource.broadcasts.stats()['subscribers'])
+metrics.gauge("ytbot_extraction_workers_busy", "Extraction workers running a job").set_function(
+    lambda: YTDLSource.scheduler.stats()['running'])
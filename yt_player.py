@@ -1,5 +1,6 @@
 import asyncio
 import threading
+import time
 
 import validators
 import re
@@ -10,10 +11,24 @@ from threading import Lock
 from functools import reduce, partial
 from enum import Enum
 from collections.abc import Generator
-from async_timeout import timeout
 
+import metrics
 import util
-from yt_dl_source import YTDLSource
+from broadcast import FRAME_SECONDS
+from extraction_scheduler import Priority
+from gapless import GaplessSource, PrimedSource
+from search_index import FILLER_WORDS, SearchIndex, tokens
+from track import Track
+from track_queue import QueueEmpty, TrackQueue
+from yt_dl_source import YTDLSource, instrumented
+
+SONGS_STARTED = metrics.counter("ytbot_songs_started_total", "Songs which started playing")
+SONG_FAILURES = metrics.counter("ytbot_song_failures_total", "Songs which failed to play")
+TRACK_START_SECONDS = metrics.histogram("ytbot_track_start_seconds",
+                                        "Time from taking a song off the queue to handing it to the voice client")
+SEARCHES = metrics.counter("ytbot_searches_total", "Text queries, by where they were resolved", ("source",))
+SEEKS = metrics.counter("ytbot_seeks_total", "Songs restarted part way through", ("reason",))
+SEEK_SECONDS = metrics.histogram("ytbot_seek_seconds", "Time for a seek to start playing from the new position")
 
 
 class State(Enum):
@@ -35,9 +50,12 @@ class EmptyQueueException(Exception):
     pass
 
 
-# The player will disconnect from the voice channel when the queue is exhausted
+# The player will disconnect from the voice channel once it has been idle for a while
 class YtPlayer:
     __yt_regex = r"^((?:https?:)?\/\/)?((?:www|m)\.)?((?:youtube(-nocookie)?\.com|youtu.be))(\/(?:[\w\-]+\?v=|embed\/|v\/)?)([\w\-]+)(\S+)?$"
+    # Shared by every guild, so a song played in one guild can be found again from any other
+    search_index = SearchIndex()
+    search_results = 5
 
     def __init__(self, ctx, logger):
         self.bot = ctx.bot
@@ -45,54 +63,401 @@ class YtPlayer:
         self._channel = ctx.channel
         self._cog = ctx.cog
         self._logger = logger
+        # Starts songs as they are queued and as the previous one ends, see PlaybackScheduler
+        self._scheduler = ctx.cog.playback
 
-        self.queue = asyncio.Queue()
-        self.next = asyncio.Event()
+        self.queue = TrackQueue(key=lambda track: track.key, on_put=lambda: self._scheduler.wake(self.guild_id))
 
         self.np = None  # Now playing message
-        self.volume = .5
+        self.volume = ctx.bot.config.get("volume", YTDLSource.default_volume)
         self.current = None
+        self.current_track = None
+        self._dequeued_at = None
+        self._skipping = False  # The current song is being stopped on purpose, don't resume it
+        self._started_at = None  # When the current song would have started, had it played from the start
+        self._last_played = None  # (title, url) of the last song that started, for "play that again"
+
+        # How many queued songs get their stream url resolved while the current one is playing
+        self.lookahead = ctx.bot.config.get("lookahead", 2)
+        self._prefetch_task = None
+
+        # Playlists are pulled in a page at a time, and only while fewer than `playlist_buffer` songs are queued
+        self.playlist_page_size = ctx.bot.config.get("playlist_page_size") or 50
+        self.playlist_buffer = ctx.bot.config.get("playlist_buffer") or 100
+        self._dequeued = asyncio.Event()
+        self._feeders = set()
+
+        # Gapless mode starts the next song's ffmpeg a few seconds before the current song ends, and hands over to it
+        # without the voice client stopping
+        self.gapless = bool(ctx.bot.config.get("gapless"))
+        self.prime_seconds = ctx.bot.config.get("gapless_prime_seconds") or 5
+        self.crossfade = ctx.bot.config.get("crossfade") or 0
+        self._chain = None  # GaplessSource the voice client is playing
+        self._primed = None  # Track of the song queued up on the chain
+        self._prime_task = None
+
+        self._scheduler.register(self)
+
+    @property
+    def guild(self):
+        return self._guild
+
+    @property
+    def guild_id(self) -> int:
+        return self._guild.id
+
+    @classmethod
+    def configure(cls, config):
+        cls.search_results = config.get("search_results") or 5
+        cls.search_index = SearchIndex(ttl=config.get("search_cache_ttl") or 3600)
+
+    async def next_source(self):
+        """Takes songs off the queue until one of them can be played, and returns its source.
+        Returns None once the queue is empty."""
+        while not self.bot.is_closed() and self._guild.voice_client is not None:
+            try:
+                track = self.queue.get_nowait()
+            except QueueEmpty:
+                return None
+            self._dequeued.set()
+            self._dequeued_at = time.perf_counter()
 
-        ctx.bot.loop.create_task(self.player_loop())
-
-    async def player_loop(self):
-        """Our main player loop."""
-        await self.bot.wait_until_ready()
-
-        while not self.bot.is_closed():
-            self.next.clear()
-
+            requester = self._guild.get_member(track.requester_id) or discord.Object(track.requester_id)
             try:
-                # Wait for the next song. If we timeout cancel the player and disconnect...
-                async with timeout(300):  # 5 minutes...
-                    source = await self.queue.get()
-            except asyncio.TimeoutError:
-                return self.destroy(self._guild)
-
-            if not isinstance(source, YTDLSource):
-                # Source was probably a stream (not downloaded)
-                # So we should regather to prevent stream expiration
-                try:
-                    source = await YTDLSource.regather_stream(source, loop=self.bot.loop)
-                except Exception as e:
-                    await self._channel.send(f'There was an error processing your song.\n'
-                                             f'```css\n[{e}]\n```')
-                    continue
-
-            source.volume = self.volume
-            self.current = source
-
-            self._guild.voice_client.play(source, after=lambda _: self.bot.loop.call_soon_threadsafe(self.next.set))
-            embed = discord.Embed(title="Now playing", description=f"[{source.title}]({source.web_url}) [{source.requester.mention}]", color=discord.Color.green())
-            self.np = await self._channel.send(embed=embed)
-            await self.next.wait()
-
-            # Make sure the FFmpeg process is cleaned up.
+                if track.broadcast:
+                    source = await YTDLSource.join_broadcast(track, loop=self.bot.loop, requester=requester,
+                                                             guild_id=self._guild.id, volume=self.volume)
+                else:
+                    # Stream urls expire, so the stream is only resolved now that the song is up
+                    source = await YTDLSource.regather_stream(track, loop=self.bot.loop, requester=requester,
+                                                              guild_id=self._guild.id, volume=self.volume,
+                                                              start_at=track.start_at)
+            except Exception as e:
+                SONG_FAILURES.inc()
+                # Not awaited, so a run of broken songs doesn't wait on the rate limit before trying the next one
+                self._cog.outbox.error(self._channel, e)
+                continue
+            self.current_track = track
+            return source
+        return None
+
+    def play(self, source, *, after):
+        """Hands a source from next_source() to the voice client."""
+        source.volume = self.volume
+        if self.gapless:
+            self._chain = GaplessSource(source, self.current_track.duration, loop=self.bot.loop,
+                                        on_near_end=self.__prime, on_advance=self.__advanced,
+                                        prime_seconds=self.prime_seconds, crossfade=self.crossfade)
+            self._guild.voice_client.play(self._chain, after=after)
+        else:
+            self._guild.voice_client.play(source, after=after)
+        self.current = source
+        TRACK_START_SECONDS.observe(time.perf_counter() - self._dequeued_at)
+        self.__started(source)
+
+    def __started(self, source):
+        SONGS_STARTED.inc()
+        self._started_at = time.time() - source.position
+        self._last_played = (source.title, source.web_url)
+        self.search_index.remember(source.title, source.web_url)
+        self.__start_prefetch(source)
+
+    def __prime(self):
+        """Called by the chain as the current song nears its end."""
+        if self._chain is not None and self._primed is None and self._prime_task is None:
+            self._prime_task = self.bot.loop.create_task(self.__prime_next(self._chain))
+            self._prime_task.add_done_callback(lambda _: setattr(self, '_prime_task', None))
+
+    async def __prime_next(self, chain):
+        page = self.queue.page(0, 1)
+        if not page or page[0][1].broadcast:
+            return  # Broadcasts are joined when they come up
+        entry_id, track = page[0]
+        requester = self._guild.get_member(track.requester_id) or discord.Object(track.requester_id)
+        try:
+            source = await YTDLSource.regather_stream(track, loop=self.bot.loop, requester=requester,
+                                                      guild_id=self._guild.id, volume=self.volume,
+                                                      start_at=track.start_at)
+        except Exception as e:
+            # Left in the queue, next_source tries it again, and reports the error, once the current song has ended
+            self._logger.debug(f"Failed to prime '{track.title}': {e}")
+            return
+        # The song stays queued until it's primed, in case the queue changes meanwhile
+        still_next = self.queue.page(0, 1) == [(entry_id, track)]
+        if chain is not self._chain or not still_next or not chain.queue_next(PrimedSource(source), track.duration):
             source.cleanup()
-            self.current = None
+            return
+        self.queue.remove(entry_id)
+        self._dequeued.set()
+        self._primed = track
+        self._logger.debug(f"Primed '{track.title}' for a gapless start")
+
+    def __advanced(self):
+        """Called by the chain once it has moved on to the primed song."""
+        track, self._primed = self._primed, None
+        if self._chain is None or track is None:
+            return
+        self.current = self._chain.current
+        self.current_track = track
+        self.__started(self.current)
+        self.bot.loop.create_task(self.announce(self.current))
+
+    def __unprime(self):
+        """Takes the primed song back off the chain and returns it to the front of the queue."""
+        if self._prime_task is not None:
+            self._prime_task.cancel()
+        if self._primed is not None and self._chain is not None and self._chain.drop_next():
+            self.queue.push_front(self._primed)
+        self._primed = None
+
+    async def announce(self, source):
+        embed = discord.Embed(title="Now playing", description=f"[{source.title}]({source.web_url}) [<@{self.current_track.requester_id}>]", color=discord.Color.green())
+        # Edits the last "Now playing" message rather than adding another one
+        self.np = await self._cog.outbox.now_playing(self._channel, embed, previous=self.np)
+
+    def finish_song(self, error=None):
+        source, track = self.current, self.current_track
+        # A song primed on the chain goes back to the front of the queue, to be played the usual way
+        self.__unprime()
+        # Make sure the FFmpeg process is cleaned up.
+        if self._chain is not None:
+            self._chain.cleanup()
+            self._chain = None
+        elif source is not None:
+            source.cleanup()
+        self.current = None
+        self.current_track = None
+        self._started_at = None
+
+        skipped, self._skipping = self._skipping, False
+        if skipped or source is None or track is None or track.broadcast or not track.duration:
+            return
+        # A stream that dropped, or stalled through a voice reconnect, ends early. Pick it up from where it stopped,
+        # as long as it got somewhere since it last started, so a stream that can't play at all isn't retried forever.
+        if source.position < track.duration - 5 and source.frames * FRAME_SECONDS >= 1:
+            self._logger.info(f"'{track.title}' stopped at {source.position:.0f}s of {track.duration:.0f}s"
+                              f"{f' ({error})' if error else ''}, resuming it")
+            SEEKS.inc(reason="resume")
+            self.queue.push_front(Track(track.webpage_url, track.title, track.duration, track.requester_id,
+                                        start_at=round(source.position, 2)))
+
+    @property
+    def position(self) -> Optional[float]:
+        """Seconds into the current song, or None if nothing is playing."""
+        return self.current.position if self.current is not None else None
+
+    def skip(self) -> bool:
+        """Stops the current song, and moves on to the next one. Returns False if nothing was playing."""
+        voice_client = self._guild.voice_client
+        if voice_client is None or not voice_client.is_playing():
+            return False
+        self._skipping = True
+        self.__unprime()
+        voice_client.stop()
+        return True
+
+    def play_next(self, track: Track) -> bool:
+        """Puts `track` at the front of the queue and skips to it. Returns False if nothing was playing, in which case
+        it is simply next up."""
+        # A primed song goes back to the front of the queue, so it has to be taken back before `track` is put there
+        self.__unprime()
+        self.queue.push_front(track)
+        return self.skip()
+
+    async def seek(self, position: float) -> float:
+        """Restarts the current song `position` seconds in, and returns the position it restarted from.
+        ffmpeg seeks on the input side, in the downloaded file or in the stream url cached when the song started,
+        so yt_dlp is only asked again if that url has expired since."""
+        start = time.perf_counter()
+        source, track = self.current, self.current_track
+        voice_client = self._guild.voice_client
+        if source is None or track is None or voice_client is None:
+            raise InvalidInputException("Nothing is playing.")
+        if track.broadcast:
+            raise InvalidInputException("Live broadcasts can't be seeked.")
+        position = max(0., position)
+        if track.duration:
+            position = min(position, max(0., track.duration - 1))
+
+        replacement = await YTDLSource.regather_stream(track, loop=self.bot.loop, requester=source.requester,
+                                                       guild_id=self._guild.id, volume=self.volume, start_at=position)
+        if self.current is not source or voice_client.source is not (self._chain or source):
+            replacement.cleanup()
+            raise InvalidInputException("The song ended before it could be seeked.")
+        if self._chain is not None:
+            # The chain swaps it in, and cleans up the old source, at its next read
+            self._chain.replace_current(replacement)
+        else:
+            # Swapped in under the playing voice client, so `after` isn't called and the song doesn't count as ended
+            voice_client.source = replacement
+            # The voice client may be part way through reading a frame from the old source
+            self.bot.loop.call_later(.5, source.cleanup)
+        self.current = replacement
+        self._started_at = time.time() - position
+        SEEKS.inc(reason="seek")
+        SEEK_SECONDS.observe(time.perf_counter() - start)
+        return position
+
+    def checkpoint(self) -> Optional[dict]:
+        """The player's state as plain data, for PlayerStore, or None if there is nothing to restore.
+        Stream urls still cached for the current and next few songs are included, so a restore doesn't have to
+        extract them again."""
+        voice_client = self._guild.voice_client
+        if voice_client is None or voice_client.channel is None or (self.current is None and self.queue.empty()):
+            return None
+
+        current = None
+        if self.current_track is not None:
+            position = self.position if self.current is not None else self.current_track.start_at
+            # Kept as it is from one checkpoint to the next, so PlayerStore can tell the player hasn't changed, unless
+            # playback has fallen behind the clock, like through a stall
+            if self._started_at is None or abs(time.time() - position - self._started_at) > 2:
+                self._started_at = round(time.time() - position)
+            current = {**self.__track(self.current_track), 'started_at': self._started_at}
+        # A song primed for a gapless start has left the queue, but hasn't started yet
+        queue = ([self._primed] if self._primed else []) + list(self.queue)
+        tracks = ([self.current_track] if current else []) + queue[:self.lookahead]
+        streams = {}
+        for track in tracks:
+            info = YTDLSource.cache.peek(track.key)
+            if info is not None:
+                streams[track.webpage_url] = info
+        return {'channel_id': self._channel.id, 'voice_channel_id': voice_client.channel.id, 'volume': self.volume,
+                'current': current, 'queue': [self.__track(track) for track in queue], 'streams': streams}
+
+    @classmethod
+    def restored_tracks(cls, state: dict, alive_at: float) -> [Track]:
+        """The songs still to play from a checkpoint, with the song that was playing first, resuming where it was
+        when the previous process was last alive. A song which would have finished by now is left out."""
+        tracks = [cls.__entry(track) for track in state['queue']]
+        current = state.get('current')
+        if current is not None:
+            start_at = max(0., alive_at - current['started_at']) if current.get('started_at') else 0.
+            if not current.get('duration') or start_at < current['duration'] - 1:
+                tracks.insert(0, cls.__entry(current, start_at=round(start_at, 2)))
+        return tracks
+
+    def restore(self, state: dict, tracks: [Track]) -> int:
+        """Queues the songs from restored_tracks(). Nothing is extracted until the songs come up. Returns the number
+        of songs queued."""
+        self.volume = state.get('volume', self.volume)
+        for track in tracks:
+            self.queue.put_nowait(track)
+        return len(tracks)
+
+    @staticmethod
+    def __track(track: Track) -> dict:
+        return {'webpage_url': track.webpage_url, 'title': track.title, 'duration': track.duration,
+                'requester_id': track.requester_id, 'broadcast': track.broadcast}
+
+    @staticmethod
+    def __entry(track: dict, start_at=0.) -> Track:
+        return Track(track['webpage_url'], track['title'], track.get('duration'), track['requester_id'],
+                     broadcast=track.get('broadcast', False), start_at=start_at)
+
+    def __start_prefetch(self, current):
+        if self._prefetch_task is not None:
+            self._prefetch_task.cancel()
+        if self.lookahead > 0:
+            self._prefetch_task = self.bot.loop.create_task(self.prefetch(current))
+
+    async def prefetch(self, current):
+        """Resolves the stream urls of the next few queued songs while the current one is playing, so that
+        regather_stream is answered from the cache once they come up.
+        Only entries whose cached url would expire before they get to play are re-resolved."""
+        play_at = time.time() + (current.duration or 0)
+        for track in self.queue.peek(self.lookahead):
+            if track.broadcast:
+                continue  # Broadcasts resolve their own stream
+            try:
+                if await YTDLSource.resolve_ahead(track.webpage_url, loop=self.bot.loop, play_at=play_at,
+                                                  guild_id=self._guild.id):
+                    self._logger.debug(f"Resolved stream ahead of time for '{track.title}'")
+            except Exception as e:
+                # Not fatal, regather_stream will try again when the song comes up
+                self._logger.warning(f"Failed to resolve '{track.title}' ahead of time: {e}")
+            play_at += track.duration or 0
+
+    async def resolve(self, query: str) -> str:
+        """Turns a text query into a video url. Urls are returned as they are.
+        Recently played songs and recent searches are answered without going to youtube."""
+        if validators.url(query):
+            return query
+
+        if not set(tokens(query)) - FILLER_WORDS and 'again' in tokens(query) and self._last_played is not None:
+            # "play that song again"
+            SEARCHES.inc(source="again")
+            self._logger.debug(f"Resolved '{query}' to the last played song '{self._last_played[0]}'")
+            return self._last_played[1]
+
+        local = self.search_index.local_match(query)
+        if local is not None:
+            SEARCHES.inc(source="local")
+            url, similar = local
+        else:
+            cached = self.search_index.cached(query)
+            if cached:
+                SEARCHES.inc(source="cached")
+                similar, url, _ = cached[0]
+            else:
+                SEARCHES.inc(source="youtube")
+                url, similar = await YTDLSource.run_extraction(partial(self.__search, query), guild_id=self._guild.id,
+                                                               priority=Priority.PLAYBACK)
+        self._logger.debug(f"Bot is {similar * 100:.0f}% sure that '{url}' is a match for '{query}'.")
+        return url
+
+    @staticmethod
+    def is_playlist(query: str) -> bool:
+        return re.search(r"[?&]list=[\w\-]+", query) is not None
+
+    async def enqueue_playlist(self, ctx, url: str) -> (str, int):
+        """Queues the first page of a playlist right away and streams the rest in behind it.
+        Returns the playlist title and the number of songs queued so far."""
+        title, pages = await YTDLSource.open_playlist(url, requester_id=ctx.author.id, guild_id=self._guild.id,
+                                                      page_size=self.playlist_page_size)
+        first_page = await anext(pages, [])
+        for entry in first_page:
+            self.queue.put_nowait(entry)
+        self._logger.debug(f"Queued first {len(first_page)} song(s) of playlist '{title}'")
+
+        task = self.bot.loop.create_task(self.__feed_playlist(title, pages, len(first_page)))
+        self._feeders.add(task)
+        task.add_done_callback(self._feeders.discard)
+        return title, len(first_page)
+
+    async def __feed_playlist(self, title, pages, count):
+        try:
+            while True:
+                # Backpressure: don't pull another page until the player has worked through the queue
+                while self.queue.qsize() >= self.playlist_buffer:
+                    self._dequeued.clear()
+                    await self._dequeued.wait()
+
+                page = await anext(pages, None)
+                if page is None:
+                    break
+                for entry in page:
+                    self.queue.put_nowait(entry)
+                count += len(page)
+            self._logger.debug(f"Finished queuing playlist '{title}' ({count} songs)")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._logger.error(f"Stopped queuing playlist '{title}' after {count} songs: {e}")
+            self._cog.outbox.send(self._channel, f'There was an error processing the rest of the playlist.\n'
+                                                 f'```css\n[{e}]\n```')
+        finally:
+            await pages.aclose()
 
     def destroy(self, guild):
         """Disconnect and cleanup the player."""
+        self._scheduler.unregister(self.guild_id)
+        if self._prefetch_task is not None:
+            self._prefetch_task.cancel()
+        if self._prime_task is not None:
+            self._prime_task.cancel()
+        for task in list(self._feeders):
+            task.cancel()
         return self.bot.loop.create_task(self._cog.cleanup(guild))
 
     async def join_channel(self, vc):
@@ -101,7 +466,7 @@ class YtPlayer:
         await util.async_retry_backoff(3, lambda: self.__try_join_channel(vc))
 
     async def __try_join_channel(self, vc):
-        if len(self._queue) == 0:
+        if self.queue.empty():
             raise EmptyQueueException("unable to join channel when queue is empty!")
         self._voice_channel = await vc.connect()
         self._state = State.RUNNING
@@ -118,19 +483,21 @@ class YtPlayer:
             raise InvalidStateException(expected=[State.RUNNING], actual=self._state)
         return f"*{self._curr[0]}*"
 
-    async def upcoming(self, count):
-        if self._state is State.STOPPED:
-            raise InvalidStateException(expected=[State.NOT_STARTED, State.RUNNING], actual=self._state)
-        limiter = [None] * (count + 1)
-        limiter[count] = "⋯"
-        return reduce(lambda s1, s2: f"{s1} ➠ {s2}", map(lambda k, l: f"*{l or k}*", iter(self._queue), limiter))
+    async def upcoming(self, count, offset=0):
+        """One page of the queue, formatted as `*#id title* ➠ ...`, with a trailing ⋯ if there is more after it."""
+        page = self.queue.page(offset, count)
+        if not page:
+            return "*Nothing queued*"
+        titles = [f"*#{entry_id} {item['title']}*" for entry_id, item in page]
+        if offset + len(page) < self.queue.qsize():
+            titles.append("⋯")
+        return reduce(lambda s1, s2: f"{s1} ➠ {s2}", titles)
 
     async def enqueue(self, query: str = None) -> str:
-        return await self.__add_to_playlist(query, lambda s: self._queue.update({s['title']: s}))
+        return await self.__add_to_playlist(query, self.queue.put_nowait)
 
     async def push(self, query: str = None) -> str:
-        return await self.__add_to_playlist(query,
-                                            lambda s: setattr(self, '_queue', {**{s['title']: s}, **self._queue}))
+        return await self.__add_to_playlist(query, self.queue.push_front)
 
     async def __add_to_playlist(self, query, insert_func) -> str:
         if self._state is State.STOPPED:
@@ -157,17 +524,17 @@ class YtPlayer:
                 insert_func(song)
 
     async def pop(self) -> (str, dict):
-        if self._state is State.STOPPED:
-            raise InvalidStateException(expected=[State.NOT_STARTED, State.RUNNING], actual=self._state)
-        with self._lock:
-            k = next(iter(self._queue))
-            return k, self._queue.pop(k)
-
-    def remove(self, key) -> (str, dict):
-        if self._state is not State.STOPPED:
-            raise InvalidStateException(expected=[State.NOT_STARTED, State.RUNNING], actual=self._state)
-        with self._lock:
-            return key, self._queue.pop(key)
+        if self.queue.empty():
+            raise EmptyQueueException("the queue is empty!")
+        song = self.queue.get_nowait()
+        self._dequeued.set()
+        return song['title'], song
+
+    def remove(self, entry_id: int) -> (str, dict):
+        """Removes a queued song by the entry id shown in upcoming(). Raises KeyError if there is no such entry."""
+        song = self.queue.remove(entry_id)
+        self._dequeued.set()
+        return song['title'], song
 
     # TODO: Instead of a next call, I should have a main async loop that runs in an executor
     # TODO: I should be putting in an async event lock that waits for the 'play' call to finish. Put it in `after`.
@@ -224,9 +591,18 @@ class YtPlayer:
             self.cleanup()
             raise err
 
-    # TODO implement me
     def __search(self, query) -> (str, float):
-        raise NotImplementedError("I haven't implemented search, use a url.")
+        """Searches youtube for the query, and returns the url of the result which matches it best together with how
+        well it matched. Blocks, so run it on an extraction worker."""
+        to_run = partial(YTDLSource.get_ytdl().extract_info, url=f"ytsearch{self.search_results}:{query}", download=False,
+                         process=False)
+        results = instrumented("search", to_run)()
+        ranked = self.search_index.rank(query, results.get('entries') or [])
+        if not ranked:
+            raise InvalidInputException(f"No results found for '{query}'.")
+        self.search_index.store(query, ranked)
+        similar, url, _ = ranked[0]
+        return url, similar
 
     def cleanup(self):
         if self._state is not State.RUNNING: